@@ -0,0 +1,337 @@
+import argparse
+import io
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import tracemalloc
+import urllib.request
+from contextlib import contextmanager
+from datetime import datetime
+from unittest import mock
+from urllib.parse import urlparse
+import numpy as np
+import pandas as pd
+from Snapshot import dataDir, datasets, readCSV, loadFrame
+from SharedData import getHistDF, getWeatherDF, getPredictorsDF
+from ResultCache import resultCache
+from Counters import measured, referenceCounter, feedView
+from PortalStandIn import Portal, feedFixtures, serve
+from WeatherProvider import wundergroundURL
+
+# Offline benchmarks of the hot paths of the apps and the data refresh.
+#
+# Everything runs from the checked-in CSVs, models and fixtures: while the
+# benchmarks run, the weather API is served from fixtures/, the counter feeds
+# from a local stand-in for the portal (PortalStandIn.py), and any other
+# network access fails. Each benchmark is timed `repeat` times, with its
+# setup (e.g. copying the frames it modifies) outside the timings, and the
+# results are written as JSON, with the commit they were measured on, so
+# runs can be compared between commits:
+#
+#     python Benchmarks.py --output before.json
+#     (change something)
+#     python Benchmarks.py --output after.json --compare before.json
+#
+# Groups whose dependencies are missing (e.g. fbprophet), or that fail, are
+# reported as skipped rather than ending the run.
+
+fixtureDir = os.path.join(dataDir, "fixtures")
+
+# Network resources the apps use, and the fixtures that stand in for them
+fixtureURLs = {wundergroundURL: "forecast10day.json"}
+
+class OfflineError(OSError):
+    pass
+
+@contextmanager
+def offline():
+    # Serve the fixture URLs from files, and fail any other network access
+    # but to this machine (see PortalStandIn)
+    urlopen = urllib.request.urlopen
+    def fixtureOpen(url, *args, **kwargs):
+        url = getattr(url, 'full_url', url)
+        if urlparse(url).hostname in ("127.0.0.1", "localhost"):
+            return urlopen(url, *args, **kwargs)
+        if url not in fixtureURLs:
+            raise OfflineError("Network access during benchmarks: %s" % url)
+        return open(os.path.join(fixtureDir, fixtureURLs[url]), "rb")
+    with mock.patch("urllib.request.urlopen", fixtureOpen):
+        yield
+
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd = dataDir,
+                                       stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Runner:
+    # Times benchmarks and collects their results
+
+    def __init__(self, repeat = 5, only = None):
+        self.repeat = repeat
+        self.only = re.compile(only) if only else None
+        self.results = {}
+        self.skipped = {}
+
+    def wanted(self, name):
+        return self.only is None or self.only.search(name) is not None
+
+    def run(self, name, fn, setup = None, repeat = None, number = 1, memory = False):
+        # Time fn(*setup()) `repeat` times, calling setup before each timing.
+        # With memory, also record the peak of memory allocated by one more
+        # call, under tracemalloc.
+        if not self.wanted(name): return
+        times = []
+        for _ in range(repeat or self.repeat):
+            args = setup() if setup else ()
+            start = time.perf_counter()
+            for _ in range(number):
+                fn(*args)
+            times.append((time.perf_counter() - start) / number)
+        self.results[name] = {"min": min(times), "median": float(np.median(times)),
+                              "mean": float(np.mean(times)), "repeat": len(times),
+                              "number": number}
+        peak = ""
+        if memory:
+            args = setup() if setup else ()
+            tracemalloc.start()
+            try:
+                fn(*args)
+                self.results[name]["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            peak = " %10.1f MB peak" % (self.results[name]["peak_bytes"] / 1e6)
+        print("%-40s %10.3f ms median %10.3f ms min%s" %
+              (name, 1000 * self.results[name]["median"], 1000 * min(times), peak))
+        sys.stdout.flush()
+
+    def skip(self, group, reason):
+        self.skipped[group] = reason
+        print("%-40s skipped: %s" % (group, reason))
+
+    def report(self):
+        return {"commit": gitCommit(),
+                "time": datetime.now().isoformat(timespec = 'seconds'),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": self.results,
+                "skipped": self.skipped}
+
+def benchLoading(runner):
+    # CSV parsing and index conversion, against the binary snapshots
+    for name in datasets:
+        path = os.path.join(dataDir, datasets[name]["csv"])
+        runner.run("load.csv." + name, lambda: readCSV(name, path), repeat = 3)
+        loadFrame(name) # Make sure the snapshot is current
+        runner.run("load.snapshot." + name, lambda: loadFrame(name))
+
+def benchDashboard(runner):
+    # The dashboard's filters and views, and full widget callbacks. Importing
+    # the app builds its document, as a server session would.
+    import HistoricalDashboard as hd
+
+    runner.run("filter.subsetMonth", lambda: hd.subsetMonth([6, 7, 8]))
+    runner.run("filter.subsetWeekday", lambda: hd.subsetWeekday([0, 1, 2, 3, 4]))
+    runner.run("filter.subsetHours", lambda: hd.subsetHours(7, 9))
+    runner.run("filter.subsetRain", lambda: hd.subsetRain(0, 0.1))
+    runner.run("filter.subsetWeather", lambda: hd.subsetWeather(["Rain"]))
+    runner.run("filter.subsetDaylight", lambda: hd.subsetDaylight(low = 10, high = 14))
+    runner.run("view.TypicalDay", lambda: hd.TypicalDay())
+    runner.run("view.TypicalWeek", lambda: hd.TypicalWeek())
+    runner.run("view.TypicalYear", lambda: hd.TypicalYear())
+    runner.run("view.HistoricalView", lambda: hd.HistoricalView())
+
+    # Representative widget states, as (widget, property, value) changes
+    # from the initial state
+    states = {
+        "day": [],
+        "week": [(hd.ViewDropdown, "value", "Week")],
+        "year": [(hd.ViewDropdown, "value", "Year")],
+        "historical": [(hd.ViewDropdown, "value", "Historical")],
+        "filtered": [(hd.WeekdayBoxes, "active", [0, 1, 2, 3, 4]),
+                     (hd.MonthBoxes, "active", [6, 7, 8]),
+                     (hd.HourSlider, "value", (6, 10)),
+                     (hd.WeatherBoxes, "active", [0, 2])],
+        "overlay": [(hd.ViewDropdown, "value", "Historical"),
+                    (hd.DisplayButtons, "active", 1),
+                    (hd.ScaleButtons, "active", 1)]}
+    initial = {(w, attr): getattr(w, attr) for changes in states.values()
+               for w, attr, _ in changes}
+
+    for name, changes in states.items():
+        for (w, attr), value in initial.items():
+            setattr(w, attr, value)
+        for w, attr, value in changes:
+            setattr(w, attr, value)
+        def cold():
+            resultCache.clear()
+            return ()
+        runner.run("update_data.%s.cold" % name, lambda: hd.update_data(None, None, None),
+                   setup = cold)
+        runner.run("update_data.%s.cached" % name, lambda: hd.update_data(None, None, None))
+    for (w, attr), value in initial.items():
+        setattr(w, attr, value)
+
+def benchRefresh(runner):
+    # The monthly data refresh, from feeds rebuilt from histDF
+    import PullData
+
+    portal = Portal(feedFixtures(getHistDF()), delay = 0.1) # A tenth of a second of latency
+    with serve(portal) as base:
+        urls = portal.feedURLs(base)
+        runner.run("refresh.getRawData.serial", lambda: PullData.getRawData(urls, workers = 1),
+                   repeat = 3)
+        runner.run("refresh.getRawData", lambda: PullData.getRawData(urls), repeat = 3)
+    bodies = {c.column: portal.rows(feedView(c)) for c in measured()}
+
+    # Parsing the largest feed, whole and streamed
+    from FeedParser import readRows, feedFrame
+    body = bodies[referenceCounter]
+    runner.run("refresh.parse.json_normalize",
+               lambda: pd.io.json.json_normalize(json.loads(body.decode()),
+                                                 record_path = "data").iloc[:, 8:],
+               repeat = 3, memory = True)
+    runner.run("refresh.parse.stream",
+               lambda: feedFrame(*readRows(io.BytesIO(body), len(body))[:2]),
+               repeat = 3, memory = True)
+
+    # The frames getRawData returns
+    frames = [feedFrame(*readRows(io.BytesIO(bodies[c.column]))[:2]) for c in measured()]
+    def copies():
+        return ([df.copy() for df in frames],)
+    runner.run("refresh.modifyData", PullData.modifyData, setup = copies, repeat = 3)
+    totalDF = PullData.modifyData(copies()[0])
+    runner.run("refresh.markNulls", PullData.markNulls,
+               setup = lambda: (totalDF.copy(),), repeat = 3)
+    imputed = PullData.markNulls(totalDF.copy())
+    runner.run("refresh.getDailyDF", PullData.getDailyDF,
+               setup = lambda: (imputed.copy(),), repeat = 3)
+
+    # The last month of counts added incrementally, to copies of the CSVs
+    # that end before it
+    from IncrementalUpdate import updateIncremental, stateFile
+    work = tempfile.mkdtemp()
+    cut = getHistDF().index[-1].strftime("%Y-%m-01")
+    def monthBehind():
+        for name in ["histDF", "predictorsDF", "weatherDF"]:
+            with open(os.path.join(dataDir, datasets[name]["csv"]), newline = '') as f:
+                lines = f.readlines()
+            with open(os.path.join(work, datasets[name]["csv"]), 'w', newline = '') as f:
+                f.write(lines[0])
+                f.writelines(l for l in lines[1:] if name == "weatherDF" or l[:10] < cut)
+        if os.path.exists(os.path.join(work, stateFile)): os.remove(os.path.join(work, stateFile))
+        return ()
+    try:
+        with serve(portal) as base:
+            runner.run("refresh.incremental", lambda: updateIncremental(work, base),
+                       setup = monthBehind, repeat = 3)
+    finally:
+        shutil.rmtree(work)
+
+def benchEngine(runner):
+    # Forecasting from the compact model artifacts, which needs no Prophet
+    from ModelArtifacts import ModelStore
+    from FastForecast import ForecastEngine
+    from HourlyProfiles import buildProfiles, hourlyForecast
+
+    runner.run("models.artifacts", lambda: ModelStore().allParams())
+    engine = ForecastEngine(ModelStore())
+    runner.run("engine.build", lambda: ForecastEngine(ModelStore().allParams()))
+
+    predictorsDF = getPredictorsDF()
+    future = pd.DataFrame({'ds': pd.to_datetime(predictorsDF.index[-7:]),
+                           'logPrecip': predictorsDF['logPrecip'].values[-7:],
+                           'TempHi': predictorsDF['TempHi'].values[-7:]})
+    runner.run("engine.predict.point", lambda: engine.predict(future['ds'], future),
+               number = 100)
+    runner.run("engine.predict.analytic",
+               lambda: engine.predict(future['ds'], future, intervals = True), number = 100)
+
+    profiles = buildProfiles(getHistDF(), getWeatherDF())
+    runner.run("hourly.buildProfiles", lambda: buildProfiles(getHistDF(), getWeatherDF()),
+               repeat = 3)
+    daily = engine.predict(future['ds'], future)["yhat"]
+    precip = np.exp(future['logPrecip'].values) - 1
+    runner.run("hourly.forecast",
+               lambda: hourlyForecast(profiles, future['ds'], daily, precip), number = 100)
+
+def benchForecast(runner):
+    # The Predict app's forecasts, and fitting one counter's model. Importing
+    # the app builds its document and its first forecast, from the fixtures.
+    import Predict
+    from ModelArtifacts import loadPickle, modelCount
+    from ModelTraining import trainModels
+
+    runner.run("models.pickles", lambda: [loadPickle(i) for i in range(modelCount)],
+               repeat = 3)
+    for mode in ["point", "analytic", "sampled"]:
+        runner.run("GetForecastTable." + mode,
+                   lambda: Predict.GetForecastTable(Predict.Models, days = 7,
+                                                    engine = Predict.Engine, mode = mode),
+                   repeat = 3 if mode == "sampled" else None)
+
+    # In-sample predictions over the whole history, as the model plots use
+    counter = Predict.predictorsDF.columns.get_loc(referenceCounter)
+    model, history = Predict.Models[counter], Predict.HistoryFrame(counter)
+    for mode in ["point", "analytic", "sampled"]:
+        runner.run("predictForecast.history." + mode,
+                   lambda: Predict.predictForecast(model, history, mode), repeat = 3)
+    runner.run("GrowthRates", lambda: Predict.GrowthRates(Predict.Models, Predict.Engine))
+
+    runner.run("CreateModels.one",
+               lambda: trainModels(Predict.predictorsDF, columns = [counter], processes = 1),
+               repeat = 1)
+
+groups = [("loading", benchLoading), ("dashboard", benchDashboard),
+          ("refresh", benchRefresh), ("engine", benchEngine),
+          ("forecast", benchForecast)]
+
+def compareResults(results, baseline):
+    # Median of each benchmark against a previous run's
+    lines = ["%-40s %10s %10s %8s" % ("Benchmark", "Base ms", "Now ms", "Ratio")]
+    for name, r in results["results"].items():
+        base = baseline["results"].get(name)
+        if base is None: continue
+        lines.append("%-40s %10.3f %10.3f %7.2fx" % (name, 1000 * base["median"],
+                                                    1000 * r["median"],
+                                                    r["median"] / base["median"]))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Run the offline benchmarks")
+    parser.add_argument("--output", default = "bench_output.json",
+                        help = "JSON file for the results")
+    parser.add_argument("--compare", help = "results of an earlier run to compare with")
+    parser.add_argument("--only", help = "regular expression of benchmark names to run")
+    parser.add_argument("--group", action = "append", choices = [g for g, _ in groups],
+                        help = "run only this group (repeatable)")
+    parser.add_argument("--repeat", type = int, default = 5)
+    args = parser.parse_args()
+
+    runner = Runner(repeat = args.repeat, only = args.only)
+    with offline():
+        for group, bench in groups:
+            if args.group and group not in args.group: continue
+            try:
+                bench(runner)
+            except ImportError as e: # e.g. fbprophet or matplotlib
+                runner.skip(group, "%s: %s" % (type(e).__name__, e))
+            except Exception as e: # e.g. pickles from other library versions
+                traceback.print_exc()
+                runner.skip(group, "failed, %s: %s" % (type(e).__name__, e))
+
+    results = runner.report()
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent = 1)
+    print("Results written to " + args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compareResults(results, json.load(f)))
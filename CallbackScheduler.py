@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
+
+# Debounced, off-thread execution of dashboard callbacks.
+#
+# Widget callbacks run on the Tornado IO loop that serves every session of
+# the Bokeh server, so a slider drag that recomputes the dashboard on each
+# value change freezes all other sessions. A DebouncedCallback instead:
+#   1. coalesces changes arriving within `delay` ms, so the latest state wins
+#   2. reads the widget state on the IO loop, and runs the pandas work in a
+#      process-wide worker thread pool
+#   3. applies the result to the document with a next tick callback, unless
+#      the widgets changed again in the meantime, in which case the stale
+#      result is dropped and the latest state is computed instead
+# At most one computation per session is in flight at any time.
+
+log = logging.getLogger(__name__)
+
+# Worker threads shared by all sessions in the server process
+executor = ThreadPoolExecutor(max_workers = 4)
+
+class DebouncedCallback:
+
+    def __init__(self, doc, readState, compute, apply, delay = 100):
+        # readState() reads the widgets and runs on the IO loop,
+        # compute(state) runs in a worker thread and must not touch the
+        # document, apply(result) updates the document on the IO loop
+        self.doc = doc
+        self.readState = readState
+        self.compute = compute
+        self.apply = apply
+        self.delay = delay
+        self.generation = 0 # Incremented on every widget change
+        self.scheduled = False
+        self.running = False
+
+    def __call__(self, attr, old, new):
+        # Use as a Bokeh on_change callback
+        self.generation += 1
+
+        if self.doc.session_context is None:
+            # Not served by a Bokeh server (e.g. a script or benchmark): there
+            # is no IO loop to return to, so compute synchronously
+            self.apply(self.compute(self.readState()))
+            return
+
+        if not self.scheduled and not self.running:
+            self.scheduled = True
+            self.doc.add_timeout_callback(self.start, self.delay)
+
+    def start(self):
+        # Compute the latest widget state in a worker thread. If the state
+        # cannot be read, this change is dropped and later ones still run.
+        self.scheduled = False
+        generation = self.generation
+        try:
+            future = executor.submit(self.compute, self.readState())
+        except Exception:
+            self.running = False
+            log.exception("Dashboard callback failed")
+            return
+        self.running = True
+        future.add_done_callback(lambda f: self.doc.add_next_tick_callback(
+                                     partial(self.finish, generation, f)))
+
+    def finish(self, generation, future):
+        # Back on the IO loop: apply the result if it is still current,
+        # otherwise start over with the latest state
+        self.running = False
+        if generation != self.generation:
+            self.start() # Leaves running False if it fails
+            return
+        try:
+            result = future.result()
+        except Exception:
+            log.exception("Dashboard callback failed")
+            return
+        self.apply(result)
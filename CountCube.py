@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+# Pre-aggregated count cube for the Typical Day and Typical Week views.
+#
+# Hourly counts are summed once per cell of (year, month, weekday, hour,
+# weather event bitset, rain code, daylight code), alongside the number of
+# non-null observations of every counter in the cell. Since every dashboard
+# filter is a condition on those keys, a view is a reduction over the selected
+# cells, and its cost depends on the number of cells rather than on the
+# length of the hourly history.
+
+# Filter index keys that identify a cell, see FilterIndex.buildFilterIndex
+cubeKeys = ["year", "month", "weekday", "hour", "events", "rain", "light"]
+
+def buildCountCube(df, index):
+    # Aggregate the hourly dataframe df into cube cells, given its filter index
+
+    keys = np.column_stack([index[k].astype(np.int64) for k in cubeKeys])
+    cells, inverse = np.unique(keys, axis = 0, return_inverse = True)
+    inverse = inverse.ravel()
+    n = len(cells)
+
+    values = df.values.astype(float)
+    notnull = ~np.isnan(values)
+    values = np.where(notnull, values, 0)
+
+    sums = np.empty((n, values.shape[1]))
+    counts = np.empty((n, values.shape[1]))
+    for j in range(values.shape[1]):
+        sums[:, j] = np.bincount(inverse, weights = values[:, j], minlength = n)
+        counts[:, j] = np.bincount(inverse, weights = notnull[:, j], minlength = n)
+
+    cube = {k: cells[:, i].astype(index[k].dtype) for i, k in enumerate(cubeKeys)}
+    cube["sums"] = sums
+    cube["counts"] = counts
+    cube["columns"] = df.columns
+    return cube
+
+def reduceCube(cube, mask, groups):
+    # Return the mean count of every counter for each distinct value of the
+    # per-cell group key, over the cells selected by mask. Groups without any
+    # selected cells are left out, as in a groupby over the hourly rows.
+    keys, inverse = np.unique(groups[mask], return_inverse = True)
+    sums = cube["sums"][mask]
+    counts = cube["counts"][mask]
+
+    means = np.empty((len(keys), sums.shape[1]))
+    for j in range(sums.shape[1]):
+        total = np.bincount(inverse, weights = sums[:, j], minlength = len(keys))
+        n = np.bincount(inverse, weights = counts[:, j], minlength = len(keys))
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            means[:, j] = np.where(n > 0, total / n, np.nan)
+
+    return pd.DataFrame(means, index = keys, columns = cube["columns"])
+
+def cubeDay(cube, mask):
+    # Typical Day: mean count by hour of the day
+    return reduceCube(cube, mask, cube["hour"].astype(np.int64))
+
+def cubeWeek(cube, mask):
+    # Typical Week: mean count by hour of the week. Hours are offset by four
+    # days because the epoch fell on a Thursday, so that the datetime axis
+    # shows Monday through Sunday.
+    df = reduceCube(cube, mask, cube["weekday"].astype(np.int64)*24 + cube["hour"])
+    df.index = df.index + 4*24
+    return df
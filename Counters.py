@@ -0,0 +1,118 @@
+import logging
+import os
+import re
+from collections import namedtuple
+from datetime import date
+import numpy as np
+import pandas as pd
+
+# Registry of the bicycle counters.
+#
+# Every app and script iterates over this list instead of keeping its own
+# names, URLs and start dates. A counter's position in `counters` is its
+# column number: the column order of histDF (measured counters) and of
+# predictorsDF (all counters), and the number of its model, Models<i>.pkl.
+# Adding a counter is one entry here, followed by a data refresh and a
+# training run.
+#
+#   column     column name in the data frames, e.g. "Fremont"
+#   label      name shown to users, e.g. "Fremont Bridge"
+#   url        Seattle Data Portal feed, or None for derived series
+#   firstDate  first date with valid counts; models are trained from there
+#   layout     columns of the feed after its date column, one of `layouts`,
+#              or "derived" for the sum of the measured counters
+
+log = logging.getLogger(__name__)
+
+Counter = namedtuple("Counter", ["column", "label", "url", "firstDate", "layout"])
+
+# Seattle Data Portal, or a stand-in for it (see PortalStandIn.py)
+portal = os.environ.get("BIKE_PORTAL", "https://data.seattle.gov")
+
+def feedURL(view):
+    return portal + "/api/views/" + view + "/rows.json?accessType=DOWNLOAD"
+
+def feedView(counter):
+    # Portal dataset id of a counter's feed, e.g. "65db-xm6k"
+    return re.search("/api/views/([^/]+)/rows", counter.url).group(1)
+
+# Feed columns after the date, by layout. "bike" feeds have a total and two
+# directions, "bikeped" feeds a total of both and two directions of each,
+# and "fremont" feeds (the Fremont Bridge) only the two directions.
+layouts = {"bike": ["Total", "BikeNB", "BikeSB"],
+           "bikeped": ["PBTotal", "PedNB", "PedSB", "BikeNB", "BikeSB"],
+           "fremont": ["BikeNB", "BikeSB"]}
+
+counters = [
+    Counter("BGT", "Burke Gilman Trail", feedURL("2z5v-ecg8"), date(2014, 1, 1), "bikeped"),
+    Counter("Broad", "Broad", feedURL("j4vh-b42a"), date(2014, 1, 1), "bike"),
+    Counter("Elliot", "Elliott", feedURL("4qej-qvrz"), date(2014, 1, 1), "bikeped"),
+    Counter("Fremont", "Fremont Bridge", feedURL("65db-xm6k"), date(2012, 10, 3), "fremont"),
+    Counter("MTS", "MTS Trail", feedURL("u38e-ybnc"), date(2014, 1, 1), "bikeped"),
+    Counter("NW58", "NW 58th St", feedURL("47yq-6ugv"), date(2014, 1, 1), "bike"),
+    Counter("Second", "2nd Ave", feedURL("avwm-i8ym"), date(2015, 1, 1), "bike"),
+    Counter("Spokane", "Spokane St", feedURL("upms-nr8w"), date(2014, 1, 1), "bike"),
+    Counter("Thirty", "39th Ave", feedURL("3h7e-f49s"), date(2014, 1, 1), "bike"),
+    Counter("TwoSix", "26th Ave", feedURL("mefu-7eau"), date(2014, 1, 1), "bike"),
+    Counter("Total", "Total", None, date(2015, 1, 1), "derived"),
+    ]
+
+# Counter whose hourly index is the master timeline, and which the others
+# are imputed against: the longest running one
+referenceCounter = "Fremont"
+
+# Old spellings of column names found in the data files
+columnAliases = {"Elliott": "Elliot"}
+
+def measured():
+    # Counters with a feed of their own
+    return [c for c in counters if c.url is not None]
+
+def derived():
+    return [c for c in counters if c.url is None]
+
+def columns(counterList = None):
+    return [c.column for c in (counters if counterList is None else counterList)]
+
+def byColumn(column):
+    for c in counters:
+        if c.column == column: return c
+    raise KeyError(column)
+
+def byLabel(label):
+    for c in counters:
+        if c.label == label: return c
+    raise KeyError(label)
+
+def standardColumns(df):
+    # df with old column spellings replaced by the registry's
+    return df.rename(columns = columnAliases, copy = False) # Keeps snapshot columns mapped
+
+def firstRow(index, counter):
+    # Position in a sorted date index of a counter's first valid date
+    if isinstance(counter, str): counter = byColumn(counter)
+    days = pd.DatetimeIndex(index).values.astype('datetime64[D]')
+    return int(np.searchsorted(days, np.datetime64(counter.firstDate, 'D')))
+
+def feedLayout(counter, width):
+    # Names of the columns of a counter's feed, which has `width` columns
+    # after its date. A feed whose width does not match its registered
+    # layout is named after the layout of that width.
+    names = layouts.get(counter.layout, [])
+    if len(names) != width:
+        matches = [l for l, n in layouts.items() if len(n) == width]
+        if not matches:
+            raise ValueError("Feed of %s has %d columns, expected %d (%s)" %
+                             (counter.column, width, len(names), counter.layout))
+        log.warning("Feed of %s has %d columns, not the %d of its %s layout; "
+                    "reading it as %s", counter.column, width, len(names),
+                    counter.layout, matches[0])
+        names = layouts[matches[0]]
+    return names
+
+def addDerived(df):
+    # Add the derived series (the Total) to a frame of measured counts
+    df = df.copy()
+    for c in derived():
+        df[c.column] = df[columns(measured())].sum(axis = 1)
+    return df
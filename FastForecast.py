@@ -0,0 +1,225 @@
+import math
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+# Vectorized point forecasts for all of the Prophet models at once.
+#
+# Prophet's predict() rebuilds its feature dataframes and draws 1000 trend
+# samples for the uncertainty intervals, once per model, to produce a handful
+# of numbers. The models behind Predict.py are linear growth models with
+# additive yearly and weekly seasonality and the logPrecip and TempHi
+# regressors, so their point forecast is
+#
+#   yhat = y_scale * (k*t + m + sum_j delta_j * max(t - c_j, 0)
+#                     + fourier(ds) @ beta_seasonal
+#                     + ((x - mu) / std) @ beta_regressors)
+#
+# with t = (ds - start) / t_scale. A ForecastEngine extracts these parameters
+# from each model once, folds the regressor scaling and y_scale into the
+# coefficients, and evaluates every model with a few matrix products over a
+# Fourier matrix shared by all of them.
+#
+# It can also give analytic approximations of predict()'s sampled
+# uncertainty intervals: Gaussian intervals combining the observation noise
+# with the spread of the future trend changes Prophet simulates. Beyond the
+# end of the history (t > 1), changepoints occur at Prophet's rate of S per
+# unit of t, with Laplace distributed changes of mean size lambda, so the
+# trend's variance after tau = t - 1 is 2 * S * lambda^2 * tau^3 / 3.
+
+def fourierSeries(days, period, order):
+    # Prophet's Fourier features, for days since the epoch: sin and cos of
+    # each order in turn
+    x = 2.0 * np.pi * np.outer(days, np.arange(1, order + 1)) / period
+    return np.stack([np.sin(x), np.cos(x)], axis = 2).reshape(len(days), 2*order)
+
+def normalQuantile(p):
+    # Inverse of the standard normal distribution function, by bisection
+    low, high = -10.0, 10.0
+    for _ in range(100):
+        mid = (low + high) / 2
+        if 0.5 * (1 + math.erf(mid / math.sqrt(2))) < p: low = mid
+        else: high = mid
+    return (low + high) / 2
+
+def analyticSigma(t, sigmaObs, changeSize, changepoints):
+    # Standard deviations of the trend, and of the observations around it,
+    # in units of y_scale
+    tau = np.maximum(t - 1, 0)
+    trend = changeSize * np.sqrt(2 * changepoints * tau**3 / 3)
+    return trend, np.sqrt(sigmaObs**2 + trend**2)
+
+def dayNumbers(dates):
+    # Days since the epoch, for dates, datetimes or datetime64 values
+    values = np.asarray(getattr(dates, 'values', dates))
+    return values.astype('datetime64[ns]').astype(np.int64) / 86400e9
+
+def modelParams(m):
+    # Parameters of a fitted Prophet model needed for its point forecast, as
+    # plain numbers and arrays
+    if m.growth != 'linear':
+        raise ValueError("Only linear growth models are supported")
+    beta = np.asarray(m.params['beta'], dtype = float).mean(axis = 0)
+    seasonalities = [(name, float(s['period']), int(s['fourier_order']))
+                     for name, s in m.seasonalities.items()]
+    regressors = [(name, float(r['mu']), float(r['std']))
+                  for name, r in m.extra_regressors.items()]
+    if getattr(m, 'holidays', None) is not None:
+        raise ValueError("Holiday effects are not supported")
+    return {"start": pd.Timestamp(m.start).value / 86400e9, # Days since the epoch
+            "tScale": pd.Timedelta(m.t_scale).total_seconds() / 86400, # Days
+            "yScale": float(m.y_scale),
+            "k": float(np.mean(m.params['k'])),
+            "m": float(np.mean(m.params['m'])),
+            "delta": np.asarray(m.params['delta'], dtype = float).mean(axis = 0),
+            "changepoints": np.asarray(m.changepoints_t, dtype = float),
+            "beta": beta,
+            "sigmaObs": float(np.mean(m.params['sigma_obs'])),
+            "intervalWidth": float(m.interval_width),
+            "seasonalities": seasonalities,
+            "regressors": regressors}
+
+class ForecastEngine:
+
+    def __init__(self, models):
+        # models is a list of fitted Prophet models or of their modelParams,
+        # in column order, or a ModelArtifacts.ModelStore. None entries
+        # (models that failed to fit) forecast NaN.
+        if hasattr(models, 'allParams'): models = models.allParams()
+        params = [p if p is None or isinstance(p, dict) else modelParams(p)
+                  for p in models]
+        self.size = len(params)
+        self.valid = np.array([p is not None for p in params])
+        fitted = [p for p in params if p is not None]
+
+        # Features shared by all models: each distinct seasonality once, then
+        # the raw regressors and a constant
+        self.seasonalities = []
+        self.regressors = []
+        for p in fitted:
+            for _, period, order in p["seasonalities"]:
+                if (period, order) not in self.seasonalities:
+                    self.seasonalities.append((period, order))
+            for name, _, _ in p["regressors"]:
+                if name not in self.regressors:
+                    self.regressors.append(name)
+        offsets = np.cumsum([0] + [2*order for _, order in self.seasonalities])
+        width = offsets[-1] + len(self.regressors) + 1
+
+        # Coefficients of the features for each model, with y_scale and the
+        # regressor standardization folded in
+        n = self.size
+        self.coef = np.zeros((width, n))
+        changepoints = max([len(p["changepoints"]) for p in fitted] + [0])
+        self.start = np.zeros(n)
+        self.tScale = np.ones(n)
+        self.yScale = np.zeros(n)
+        self.k = np.zeros(n)
+        self.m = np.zeros(n)
+        self.delta = np.zeros((changepoints, n))
+        self.changepoints = np.zeros((changepoints, n))
+        self.sigmaObs = np.zeros(n)
+        self.changeSize = np.zeros(n) # Mean absolute trend change
+        self.changeCount = np.zeros(n) # Changepoints per unit of t
+        self.z = np.zeros(n) # Normal quantile of each interval's upper end
+        for i, p in enumerate(params):
+            if p is None: continue
+            self.start[i], self.tScale[i], self.yScale[i] = p["start"], p["tScale"], p["yScale"]
+            self.k[i], self.m[i] = p["k"], p["m"]
+            self.sigmaObs[i] = p.get("sigmaObs", 0)
+            self.changeSize[i] = np.mean(np.abs(p["delta"])) if len(p["delta"]) else 0
+            self.changeCount[i] = len(p["changepoints"])
+            self.z[i] = normalQuantile(0.5 + p.get("intervalWidth", 0.8) / 2)
+            self.delta[:len(p["delta"]), i] = p["delta"]
+            self.changepoints[:len(p["changepoints"]), i] = p["changepoints"]
+            beta = p["beta"] * p["yScale"]
+            col = 0
+            for _, period, order in p["seasonalities"]:
+                j = offsets[self.seasonalities.index((period, order))]
+                self.coef[j:j + 2*order, i] = beta[col:col + 2*order]
+                col += 2*order
+            for name, mu, std in p["regressors"]:
+                j = offsets[-1] + self.regressors.index(name)
+                self.coef[j, i] = beta[col] / std
+                self.coef[-1, i] -= beta[col] * mu / std
+                col += 1
+
+    def features(self, dates, regressors):
+        # Shared feature matrix: Fourier terms, raw regressors and a constant
+        days = dayNumbers(dates)
+        columns = [fourierSeries(days, period, order)
+                   for period, order in self.seasonalities]
+        columns += [np.asarray(regressors[name], dtype = float)[:, None]
+                    for name in self.regressors]
+        columns.append(np.ones((len(days), 1)))
+        return days, np.hstack(columns)
+
+    def trend(self, days):
+        # Scaled time and trend of every model, for days since the epoch
+        t = (days[:, None] - self.start) / self.tScale
+        hinge = np.maximum(t[:, None, :] - self.changepoints, 0) # dates x changepoints x models
+        trend = (self.k*t + self.m + np.einsum('dcm,cm->dm', hinge, self.delta)) * self.yScale
+        return t, trend
+
+    def predict(self, dates, regressors, intervals = False):
+        # Trend and yhat of every model for the dates, given the regressor
+        # values for those dates (a dict or dataframe of columns), as arrays
+        # of shape (dates, models). With intervals, also their analytic
+        # lower and upper bounds, as trend_lower etc.
+        days, X = self.features(dates, regressors)
+        t, trend = self.trend(days)
+        result = {"trend": trend, "yhat": trend + X @ self.coef}
+        if intervals:
+            trendSigma, sigma = analyticSigma(t, self.sigmaObs, self.changeSize,
+                                              self.changeCount)
+            for name, s in [("trend", trendSigma), ("yhat", sigma)]:
+                half = self.z * self.yScale * s
+                result[name + "_lower"] = result[name] - half
+                result[name + "_upper"] = result[name] + half
+        for values in result.values():
+            values[:, ~self.valid] = np.nan
+        return result
+
+def compareWithProphet(models, future, engine = None):
+    # Largest difference between the engine's yhat and predict()'s, relative
+    # to the size of the forecast, for each model. Slow: runs predict().
+    engine = engine or ForecastEngine(models)
+    yhat = engine.predict(future['ds'], future)["yhat"]
+    errors = []
+    for i, m in enumerate(models):
+        if m is None:
+            errors.append(np.nan)
+            continue
+        expected = m.predict(future)['yhat'].values
+        errors.append(float(np.max(np.abs(yhat[:, i] - expected)) /
+                            max(np.max(np.abs(expected)), 1)))
+    return errors
+
+if __name__ == "__main__":
+    # Check the engine against predict() over the last weeks of history,
+    # and time it
+    from ModelArtifacts import ModelStore
+    from SharedData import getPredictorsDF
+
+    predictorsDF = getPredictorsDF()
+    store = ModelStore()
+    models = [store[i] for i in range(len(store))]
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 28
+    future = pd.DataFrame({'ds': pd.to_datetime(predictorsDF.index[-days:]),
+                           'logPrecip': predictorsDF['logPrecip'].values[-days:],
+                           'TempHi': predictorsDF['TempHi'].values[-days:],
+                           'floor': 0})
+
+    engine = ForecastEngine(models)
+    runs = 1000
+    start = time.perf_counter()
+    for _ in range(runs):
+        engine.predict(future['ds'], future)
+    print("%d days x %d models: %.3f ms per forecast" %
+          (days, len(models), 1000*(time.perf_counter() - start)/runs))
+
+    errors = compareWithProphet(models, future, engine)
+    for i, e in enumerate(errors):
+        print("Model %d: max relative difference %.2e" % (i, e))
+    sys.exit(not np.nanmax(errors) < 1e-6)
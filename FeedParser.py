@@ -0,0 +1,203 @@
+import codecs
+import json
+import re
+import sys
+import time
+import tracemalloc
+import urllib.request
+import numpy as np
+import pandas as pd
+
+# Streaming reader of the Seattle Data Portal's rows.json feeds.
+#
+# A feed is one JSON object, {"meta": {...}, "data": [[...], ...]}, whose
+# rows hold eight metadata fields, the date and the counts as strings, e.g.
+#
+#   ["row-x", "00000000-...", 0, 1512086400, null, 1512086400, null, "{ }",
+#    "2017-11-30T23:00:00", "12", "5", "7"]
+#
+# Loading a feed whole (json.loads, then json_normalize) holds the response,
+# its decoded text, a Python list per row and a string per field at once.
+# readRows instead reads the stream in chunks, skips to the "data" array,
+# decodes one row at a time and keeps only its date and counts, in typed
+# arrays that grow by doubling. Memory is the arrays, one chunk and one row.
+#
+#     python FeedParser.py feed.json [URL ...]
+#
+# reports the size, rows, parse time and peak memory of each feed.
+
+dateField = 8 # Position of the date in a row; the counts follow
+countsFrom = dateField + 1
+chunkSize = 1 << 18
+rowBytes = 120 # Lower bound of a row's length, to size the arrays from Content-Length
+
+whitespace = re.compile(r'[ \t\n\r]*')
+decoder = json.JSONDecoder()
+nan = float('nan')
+
+class Reader:
+    # JSON values from a byte stream, decoded a chunk at a time
+
+    def __init__(self, stream, chunkSize = chunkSize):
+        self.stream = stream
+        self.chunkSize = chunkSize
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+        self.size = 0 # Bytes read
+
+    def more(self):
+        # Append the next chunk to the unread text
+        chunk = self.stream.read(self.chunkSize)
+        self.size += len(chunk)
+        self.eof = not chunk
+        self.text = self.text[self.pos:] + self.decoder.decode(chunk, final = self.eof)
+        self.pos = 0
+
+    def peek(self):
+        # The next character after whitespace, or "" at the end
+        while True:
+            self.pos = whitespace.match(self.text, self.pos).end()
+            if self.pos < len(self.text): return self.text[self.pos]
+            if self.eof: return ""
+            self.more()
+
+    def expect(self, characters):
+        # Consume the next character, one of `characters`
+        c = self.peek()
+        if not c or c not in characters:
+            raise ValueError("Expected one of %r at byte %d of the feed, found %r" %
+                             (characters, self.size, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        # Decode the next value. One that reaches the end of the text may be
+        # cut short (e.g. a number), so it is decoded again with more text.
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.text, self.pos)
+                if end < len(self.text) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof: raise
+            self.more()
+
+    def items(self):
+        # The values of an array whose "[" has been read, through its "]".
+        # The same as value() and expect(",]") in turn, in one loop, as
+        # this runs once per row of the feed.
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        skip, decode = whitespace.match, decoder.raw_decode
+        text, pos = self.text, self.pos
+        while True:
+            start = pos
+            try:
+                item, pos = decode(text, skip(text, pos).end())
+                pos = skip(text, pos).end()
+                separator = text[pos] # Past the end if the text stops here
+            except (ValueError, IndexError):
+                if self.eof: raise ValueError("The feed ends within its data array")
+                self.pos = start
+                self.more()
+                text, pos = self.text, self.pos
+                continue
+            pos += 1
+            yield item
+            if separator == "]": break
+            if separator != ",":
+                raise ValueError("Expected ',' or ']' at byte %d of the feed, found %r" %
+                                 (self.size, separator))
+        self.pos = pos
+
+class Columns:
+    # Dates and counts of the rows read so far
+
+    def __init__(self, capacity):
+        self.capacity = max(capacity, 1024)
+        self.rows = 0
+        self.dates = np.empty(self.capacity, dtype = 'S19') # Fractions of seconds are cut off
+        self.counts = None # Sized by the first row
+
+    def add(self, row):
+        if self.rows == self.capacity: self.grow()
+        try:
+            self.counts[self.rows] = [nan if v is None else float(v) for v in row[countsFrom:]]
+        except (TypeError, ValueError):
+            if self.counts is not None: raise
+            self.counts = np.empty((self.capacity, len(row) - countsFrom))
+            return self.add(row)
+        self.dates[self.rows] = row[dateField] or "" # NaT
+        self.rows += 1
+
+    def grow(self):
+        self.capacity *= 2
+        self.dates.resize(self.capacity, refcheck = False)
+        self.counts.resize((self.capacity, self.counts.shape[1]), refcheck = False)
+
+    def arrays(self):
+        # Dates as datetime64[ns] and counts, trimmed to the rows read
+        if self.counts is None: return np.empty(0, dtype = 'datetime64[ns]'), np.empty((0, 0))
+        self.counts.resize((self.rows, self.counts.shape[1]), refcheck = False)
+        return self.dates[:self.rows].astype('datetime64[ns]'), self.counts
+
+def readRows(stream, sizeHint = None):
+    # Dates (datetime64[ns]) and counts (rows x fields, float with NaN for
+    # nulls) of a rows.json stream, and its size in bytes. sizeHint, the
+    # stream's size if known, sizes the arrays.
+    reader = Reader(stream)
+    reader.expect("{")
+    while True:
+        if reader.peek() == "}": raise ValueError("The feed has no data array")
+        key = reader.value()
+        reader.expect(":")
+        if key == "data": break
+        reader.value() # e.g. the meta object
+        if reader.expect(",}") == "}": raise ValueError("The feed has no data array")
+
+    columns = Columns(sizeHint // rowBytes if sizeHint else 1 << 16)
+    reader.expect("[")
+    for row in reader.items():
+        columns.add(row)
+    dates, counts = columns.arrays()
+    return dates, counts, reader.size
+
+def feedFrame(dates, counts):
+    # The frame json_normalize(...).iloc[:, 8:] gave: the date, then the
+    # counts, in columns numbered from 8. Counts without nulls or fractions
+    # are integers, as pd.to_numeric makes them.
+    df = pd.DataFrame({dateField: dates})
+    for j in range(counts.shape[1]):
+        values = counts[:, j]
+        if not np.isnan(values).any() and np.array_equal(values, np.floor(values)):
+            values = values.astype(np.int64)
+        df[dateField + 1 + j] = values
+    return df
+
+def profile(opener):
+    # Read a feed from opener() under tracemalloc: (rows, bytes, seconds, peak
+    # bytes allocated). The tracing itself slows the parse down.
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        with opener() as stream:
+            dates, counts, size = readRows(stream)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return len(dates), size, seconds, peak
+
+if __name__ == "__main__":
+    print("%-40s %8s %9s %8s %9s" % ("Feed", "MB", "Rows", "Seconds", "Peak MB"))
+    for source in sys.argv[1:]:
+        if re.match("https?://", source): opener = lambda: urllib.request.urlopen(source)
+        else: opener = lambda: open(source, "rb")
+        rows, size, seconds, peak = profile(opener)
+        print("%-40s %8.1f %9d %8.2f %9.1f" % (source[-40:], size / 1e6, rows, seconds,
+                                              peak / 1e6))
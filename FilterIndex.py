@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+from Metrics import laps
+
+# Precomputed integer keys for filtering the hourly counts in histDF.
+#
+# The dashboard filters used to rebuild Python date objects and chain seven
+# dataframe subsets on every widget change. Instead, every hourly row gets its
+# calendar keys (year, month, weekday, hour, day id) once at load time, along
+# with the daylight, rainfall and weather event codes of the day it falls on.
+# A widget state is then a single boolean mask over these arrays.
+
+# Weather Coding Dictionary, as used by the dashboard's weather checkboxes
+weatherDict = {0:"None",
+               1: "Fog",
+               2: "Rain",
+               3: "Snow",
+               4:"Thunderstorm"}
+
+def dayIds(dates):
+    # Convert dates or timestamps to integer days since 1970-01-01
+    return np.asarray(pd.DatetimeIndex(dates).values.astype('datetime64[D]'),
+                      dtype = 'datetime64[D]').astype(np.int64)
+
+def lightCode(hours):
+    # Encode hours of daylight so that the integer slider bounds can be
+    # compared exactly: whole hours h become 2h, anything strictly between h
+    # and h + 1 becomes 2h + 1. Missing values become -1 and never match.
+    hours = np.asarray(hours, dtype = float)
+    floor = np.floor(hours)
+    code = 2*floor + (hours != floor)
+    code[np.isnan(hours)] = -1
+    return code.astype(np.int16)
+
+def rainCode(inches):
+    # Encode daily rainfall on the 0.05 inch steps of the rain slider, in the
+    # same way as lightCode: exact multiples of 0.05 become 2q (with q the
+    # number of steps), anything strictly between two steps becomes 2q + 1.
+    # The weather data has a resolution of 0.01 inches. Missing values become
+    # -1 and never match.
+    inches = np.asarray(inches, dtype = float)
+    hundredths = np.round(np.nan_to_num(inches, nan = 0)*100).astype(np.int64)
+    steps, rest = np.divmod(hundredths, 5)
+    code = 2*steps + (rest != 0)
+    code[np.isnan(inches)] = -1
+    return code.astype(np.int16)
+
+def eventCode(events):
+    # Encode the weather events of each day as a bitset, with bit i set when
+    # weatherDict[i] is among the day's events. Days without events are "None".
+    events = pd.Series(events).fillna('None').astype(str)
+    code = np.zeros(len(events), dtype = np.int8)
+    for i, name in weatherDict.items():
+        code |= np.where(events.str.contains(name), 1 << i, 0).astype(np.int8)
+    return code
+
+def buildFilterIndex(df, wdf):
+    # Build the filter index for the hourly dataframe df, given the daily
+    # weather dataframe wdf (which holds Precip, Events and daylightHours)
+
+    stamps = pd.DatetimeIndex(df.index)
+    day = dayIds(stamps)
+
+    # Per-day codes, laid out in a table indexed by day id so they can be
+    # broadcast to the hourly rows with a single take
+    wdays = dayIds(wdf.index)
+    first = min(day.min(), wdays.min())
+    size = max(day.max(), wdays.max()) - first + 1
+
+    light = np.full(size, -1, dtype = np.int16)
+    rain = np.full(size, -1, dtype = np.int16)
+    events = np.zeros(size, dtype = np.int8)
+    light[wdays - first] = lightCode(wdf["daylightHours"])
+    rain[wdays - first] = rainCode(pd.to_numeric(wdf["Precip"]))
+    events[wdays - first] = eventCode(wdf["Events"].values)
+
+    return {"year": stamps.year.values.astype(np.int16),
+            "month": stamps.month.values.astype(np.int8),
+            "weekday": stamps.weekday.values.astype(np.int8),
+            "hour": stamps.hour.values.astype(np.int8),
+            "day": day,
+            "light": light[day - first],
+            "rain": rain[day - first],
+            "events": events[day - first]}
+
+def isMember(values, allowed, size):
+    # Vectorized isin for small non-negative integer keys, via a lookup table
+    table = np.zeros(size, dtype = bool)
+    table[[a for a in allowed if 0 <= a < size]] = True
+    return table[values]
+
+def filterMask(index, years, months, weekdays, hours = (0, 23),
+               light = (8, 16), weather = range(5), rain = (0, 2.5)):
+    # Return a boolean mask over the rows of a filter index (or any dict with
+    # the same keys), keeping rows that satisfy every widget filter:
+    #   years, months, weekdays: lists of allowed values (weekday 0 = Monday)
+    #   hours: inclusive (start, end) hour range, 24 hour format
+    #   light: inclusive (low, high) hours of daylight, in whole hours
+    #   weather: list of weatherDict codes; a day matches if any occurred
+    #   rain: inclusive (low, high) inches of rain per day
+
+    timer = laps("filter") # Times each filter, while metrics are enabled
+    year = index["year"]
+    mask = isMember(year - 2000, [y - 2000 for y in years], 200)
+    timer.lap("years")
+    mask &= isMember(index["month"], months, 13)
+    timer.lap("months")
+    mask &= isMember(index["weekday"], weekdays, 7)
+    timer.lap("weekdays")
+
+    hour = index["hour"]
+    mask &= (hour >= int(hours[0])) & (hour <= int(hours[1]))
+    timer.lap("hours")
+
+    code = index["light"]
+    mask &= (code >= 2*light[0]) & (code <= 2*light[1])
+    timer.lap("light")
+
+    code = index["rain"]
+    mask &= (code >= 2*round(rain[0]*20)) & (code <= 2*round(rain[1]*20))
+    timer.lap("rain")
+
+    bits = 0
+    for i in weather: bits |= 1 << i
+    mask &= (index["events"] & bits) != 0
+    timer.lap("weather")
+
+    return mask
@@ -0,0 +1,49 @@
+import copy
+import numpy as np
+import pandas as pd
+from FastForecast import modelParams, analyticSigma, normalQuantile
+
+# Forecast modes for Prophet predictions.
+#
+# predict() always simulates uncertainty_samples (1000) trends and
+# observations per row for its intervals, which dominates its cost over
+# years of history, even where only yhat, the trend or the components are
+# used. predictForecast returns the same dataframe as predict(), with:
+#   "point"    no intervals: the lower and upper bounds equal the estimate
+#   "analytic" Gaussian approximations of the intervals (see FastForecast)
+#   "sampled"  predict()'s simulated intervals, from `samples` samples
+
+forecastModes = ("point", "analytic", "sampled")
+
+def predictForecast(m, future, mode = "point", samples = 1000):
+    if mode not in forecastModes:
+        raise ValueError("Unknown forecast mode %r, expected one of %s" %
+                         (mode, ", ".join(forecastModes)))
+
+    if mode == "sampled":
+        # On a shallow copy, as the model is shared by concurrent requests
+        m = copy.copy(m)
+        m.uncertainty_samples = samples
+        return m.predict(future)
+
+    # predict(), without predict_uncertainty()
+    df = m.setup_dataframe(future.copy())
+    df['trend'] = m.predict_trend(df)
+    seasonal = m.predict_seasonal_components(df)
+    forecast = pd.concat((df[['ds', 'trend']], seasonal), axis = 1)
+    forecast['yhat'] = forecast['trend'] + forecast['seasonal']
+
+    if mode == "point":
+        trendHalf = halfWidth = 0
+    else:
+        p = modelParams(m)
+        changeSize = np.mean(np.abs(p["delta"])) if len(p["delta"]) else 0
+        trendSigma, sigma = analyticSigma(df['t'].values, p["sigmaObs"], changeSize,
+                                          len(p["changepoints"]))
+        z = normalQuantile(0.5 + m.interval_width / 2) * m.y_scale
+        trendHalf, halfWidth = z * trendSigma, z * sigma
+    forecast['trend_lower'] = forecast['trend'] - trendHalf
+    forecast['trend_upper'] = forecast['trend'] + trendHalf
+    forecast['yhat_lower'] = forecast['yhat'] - halfWidth
+    forecast['yhat_upper'] = forecast['yhat'] + halfWidth
+    return forecast
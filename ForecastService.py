@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Server-wide forecast, refreshed on a schedule.
+#
+# The 7 day forecast only changes when the weather forecast or the date
+# changes, so rather than calling the weather API and the models for every
+# page view, a ForecastService computes it once and shares it with every
+# session. A daemon thread recomputes it every `interval` seconds and just
+# after local midnight. If a refresh fails (e.g. the weather API is down),
+# the last good forecast keeps being served and the refresh is retried after
+# `retry` seconds.
+
+log = logging.getLogger(__name__)
+
+def localNow():
+    # Current time in Seattle, ignoring daylight saving, as GetForecastTable
+    # has always computed it
+    return datetime.utcnow() - timedelta(hours=8)
+
+def secondsToMidnight(now = None):
+    now = now or localNow()
+    midnight = datetime.combine(now.date() + timedelta(days = 1), datetime.min.time())
+    return (midnight - now).total_seconds()
+
+class ForecastService:
+
+    def __init__(self, compute, interval = 3600, retry = 300, start = True):
+        # compute() returns the forecast, and runs in the refresh thread
+        self.compute = compute
+        self.interval = interval
+        self.retry = retry
+        self.value = None
+        self.version = 0 # Incremented by every successful refresh
+        self.updated = None # time.time() of the last successful refresh
+        self.lastError = None
+        self.failures = 0 # Consecutive failed refreshes
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.startThread = start
+
+    def get(self):
+        # The current forecast. The first call computes it, and raises if
+        # that fails, since there is nothing to serve yet.
+        if self.value is None:
+            with self.lock:
+                if self.value is None and not self.refresh():
+                    raise RuntimeError("No forecast available: %s" % self.lastError)
+            if self.startThread and self.thread is None:
+                self.thread = threading.Thread(target = self.run, daemon = True,
+                                               name = "ForecastService")
+                self.thread.start()
+        return self.value
+
+    def refresh(self):
+        # Recompute the forecast, keeping the last good one on failure.
+        # Returns whether the refresh succeeded.
+        start = time.time()
+        try:
+            value = self.compute()
+        except Exception as e:
+            self.failures += 1
+            self.lastError = "%s: %s" % (type(e).__name__, e)
+            log.exception("Forecast refresh failed")
+            return False
+        self.value = value
+        self.version += 1
+        self.updated = time.time()
+        self.failures = 0
+        self.lastError = None
+        log.info("Forecast refreshed in %.2f s", self.updated - start)
+        return True
+
+    def nextRefresh(self):
+        # Seconds until the next refresh is due: the interval, or a retry
+        # after a failure, but never later than just after local midnight
+        delay = self.retry if self.failures else self.interval
+        if self.updated is not None and not self.failures:
+            delay -= time.time() - self.updated
+        return max(min(delay, secondsToMidnight() + 1), 0)
+
+    def run(self):
+        while not self.stopped.wait(self.nextRefresh()):
+            with self.lock:
+                self.refresh()
+
+    def stop(self):
+        self.stopped.set()
+
+    def age(self):
+        # Seconds since the forecast was computed, or None before that
+        return None if self.updated is None else time.time() - self.updated
+
+    def status(self):
+        return {"version": self.version,
+                "updated": self.updated,
+                "age": self.age(),
+                "failures": self.failures,
+                "lastError": self.lastError}
+
+def describeAge(service, updated = None):
+    # Short text for the page, e.g. "Forecast updated 12 minutes ago". A page
+    # showing an earlier forecast passes the time.time() it was refreshed at.
+    age = service.age() if updated is None else time.time() - updated
+    if age is None: return "Forecast not available"
+    minutes = int(age // 60)
+    if minutes < 1: text = "Forecast updated just now"
+    elif minutes < 120: text = "Forecast updated %d minute%s ago" % (minutes, "s"*(minutes != 1))
+    else: text = "Forecast updated %d hours ago" % (minutes // 60)
+    if updated is not None and updated != service.updated:
+        text += " (reload the page for a newer one)"
+    if service.failures:
+        text += " (refresh failing: %s)" % service.lastError
+    return text
@@ -1,67 +1,56 @@
 from datetime import datetime #, date
 import pandas as pd
 from bokeh.layouts import widgetbox, layout
-from bokeh.models import ColumnDataSource,CheckboxButtonGroup, DatetimeTickFormatter
-from bokeh.models.widgets import Select, RangeSlider
+from bokeh.models import ColumnDataSource,CheckboxButtonGroup, DatetimeTickFormatter, Legend, LegendItem, Range1d
+from bokeh.models.widgets import Select, RangeSlider, RadioButtonGroup
+from bokeh.palettes import Category10
 from bokeh.io import curdoc
 #from urllib.request import urlopen
 from bokeh.plotting import figure
 #from bokeh.io import output_file, show
 import numpy as np
 import emoji
+from FilterIndex import buildFilterIndex, filterMask
+from CountCube import buildCountCube, cubeDay, cubeWeek
+from ResultCache import resultCache, dataToken, dashboardKey
+from SharedData import shared, getHistDF, getWeatherDF
+from CallbackScheduler import DebouncedCallback
+from LevelOfDetail import buildPyramid, pickLevel, levelOfDetail
+from SourceUpdate import SourceUpdater
+from Counters import measured
+from Metrics import timed, labelled, trackSession, start as startMetrics
 
 #cd C:\Users\asher\Documents\GitHub\data602-finalproject 
 #bokeh serve HistoricalDashboard.py --show
 
-# Counter locations for displaying to user
-counterNames = ["2nd Ave", "26th Ave", "39th Ave", "Burke Gilman Trail", "Broad", 
-                "Elliot", "Fremont Bridge",
-                "MTS Trail", "NW 58th St",  "Spokane St"]
-
-# Dictionary for converting full trail names to column numbers
-counterDict = {"Burke Gilman Trail":0,
-               "Broad": 1,
-               "Elliot": 2,
-               "Fremont Bridge": 3,
-               "MTS Trail": 4,
-               "NW 58th St": 5,
-               "2nd Ave": 6,
-               "Spokane St": 7,
-               "39th Ave": 8,
-               "26th Ave": 9}
-
-# Weather Coding Dictionary
-weatherDict = {0:"None", 
-               1: "Fog", 
-               2: "Rain", 
-               3: "Snow",
-               4:"Thunderstorm"}
-
-# Get dataframe of historical observations, weather, and daylight hours
-histPath = "https://raw.githubusercontent.com/cspitmit03/data602-finalproject/master/histDF.csv"
-weatherPath = "https://raw.githubusercontent.com/cspitmit03/data602-finalproject/master/weatherDF.csv"
-#histPath = r"C:\Users\asher\Documents\GitHub\data602-finalproject\histDF.csv"
-#weatherPath = r"C:\Users\asher\Documents\GitHub\data602-finalproject\weatherDF.csv"
-
-histDF = pd.read_csv(histPath, index_col = 0) # From Seattle Data Portal
-weatherDF = pd.read_csv(weatherPath, index_col = 0) # From WeatherUnderground
-
-# Set indices of hist and weather as datetime & date objects, respectively
-Indx = [] # Index to house dates
-for i in range(len(histDF)): 
-    Indx.append(datetime.strptime(histDF.index[i], '%Y-%m-%d %H:%M:%S'))
-histDF.index = Indx
-#histDF.index = histDF.index.to_pydatetime()
-
-Indx = [] # Index to house dates
-for i in range(len(weatherDF)): 
-    Indx.append(datetime.strptime(weatherDF.index[i], '%Y-%m-%d').date())
-weatherDF.index = Indx
-
-weatherDF["Precip"] = pd.to_numeric(weatherDF["Precip"])
+# Get dataframe of historical observations, weather, and daylight hours.
+# Indices of hist and weather are datetime & date objects, respectively.
+# These are loaded once per server process and shared by all sessions, so
+# they must not be modified.
+histDF = getHistDF() # From Seattle Data Portal
+weatherDF = getWeatherDF() # From WeatherUnderground
+
+# Counter locations for displaying to user, from the counter registry, and
+# their column numbers in histDF
+counterDict = {c.label: histDF.columns.get_loc(c.column) for c in measured()}
+counterNames = sorted(counterDict)
+
+# Integer filter keys for every hourly row, used by the widget callbacks
+filterIndex = shared("filterIndex", lambda: buildFilterIndex(histDF, weatherDF))
+
+# Hourly sums and counts per filter cell, for the Typical Day and Week views
+countCube = shared("countCube", lambda: buildCountCube(histDF, filterIndex))
+
+# Results cached by other sessions stay valid unless the data has changed
+cacheName = "HistoricalDashboard"
+resultCache.validate(cacheName, dataToken(histDF, weatherDF))
 
 MyTools = "pan,hover,wheel_zoom,box_zoom,reset,undo,save"
 
+# Stage timings and session counts, served when metrics are enabled
+startMetrics()
+trackSession(curdoc(), "HistoricalDashboard")
+
 def subsetMonth(monthList, df=histDF):
     # Return dataframe containing only the days of the week specified,
     # where 0 = Monday, 1 = Tuesday, etc.
@@ -105,8 +94,8 @@ def subsetWeather(weatherList, wdf = weatherDF, df = histDF):
     # Note, if there were also fog on a given day, 
     # that date would show up in the returned dataframe.
     
-    # Set weather Events field null values to empty strings
-    wdf.Events = wdf.Events.replace(np.nan, 'None', regex=True)
+    # Set weather Events field null values to 'None', leaving wdf unchanged
+    events = wdf.Events.replace(np.nan, 'None', regex=True)
     
     # Dates with the specified weather conditions
     dfDates = pd.Series(df.index.date) # All dates in dataset
@@ -115,7 +104,7 @@ def subsetWeather(weatherList, wdf = weatherDF, df = histDF):
     
     # Create list of lists of dates satisfying filters
     for event in weatherList:
-        filterDates.append(wdf.index[wdf['Events'].str.contains(event)])
+        filterDates.append(wdf.index[events.str.contains(event)])
     
     # Convert list of lists into flat list
     filterDates = [item for sublist in filterDates for item in sublist]
@@ -153,11 +142,10 @@ def TypicalDay(df = histDF):
 def TypicalWeek(df = histDF):
     df = df.groupby([df.index.weekday, df.index.hour])[df.columns].mean()
     
-    indx = np.array([])
-    for i in range(len(df.index)):
-        indx = np.append(indx, df.index[i][0]*24 + df.index[i][1] + 4*24)
-    
-    df.index = indx
+    # Hour of the week, offset by four days since the epoch was a Thursday
+    weekday = df.index.get_level_values(0).values
+    hour = df.index.get_level_values(1).values
+    df.index = (weekday*24 + hour + 4*24).astype(float)
     return df
 
 def TypicalYear(df = histDF):
@@ -171,14 +159,15 @@ def TypicalYear(df = histDF):
     df = df.groupby(df.index).mean()
     
     # Last week is only one day, so exclude it
-    df = df.iloc[0:52, :]
+    df = df[df.index <= 52]
     
-    # Convert indices to start at 0 instead of 1
-    df.index = list(range(52))
+    # Convert indices to start at 0 instead of 1. Filters may leave weeks
+    # out (or all of them, when no year is selected)
+    df.index = np.asarray(df.index, dtype = int) - 1
     
     return df
 
-def HistoricalView(df = histDF.copy()):
+def HistoricalView(df = histDF):
     # Calculate the historical weekly sum
     df = df.resample('7D').sum()
     
@@ -198,8 +187,10 @@ source = ColumnDataSource(data=dict(x=x, y=y))
 def plotBokeh(ymax = 800):
     
     # Set up plot
+    # The x range is set by showResult, so that zooming into the Historical
+    # view can be answered with more detail
     plot = figure(plot_height=600, plot_width=800, title="Bicycle Counts",
-                  tools=MyTools) # y_range=[0, ymax])
+                  tools=MyTools, x_range=Range1d(min(x), max(x))) # y_range=[0, ymax])
                   #x_range=[0, 23]
     plot.xaxis.axis_label = "Date/Time" # x axis label
     #plot.xaxis.ticker = list(np.array([0, 6, 8, 10, 12, 14, 16, 18, 20, 
@@ -208,13 +199,34 @@ def plotBokeh(ymax = 800):
                                                  days = ['%a'], 
                                                  months = ['%b']) 
                                                  #years = ['%Y'])
-    plot.line('x', 'y', source=source, line_width=3, line_alpha=0.6)
+    plot.line('x', 'y', source=source, line_width=3, line_alpha=0.6, 
+              name="counter")
     
     plot.yaxis.major_label_orientation = "vertical"
     
     return plot
 
 plot = plotBokeh()
+counterLine = plot.select_one({"name": "counter"})
+
+# One line per counter for the overlay view, numbered by column like
+# counterDict, and a legend listing the visible ones
+columnNames = {i: name for name, i in counterDict.items()}
+overlaySources = []
+overlayItems = []
+for i in range(len(counterDict)):
+    overlaySources.append(ColumnDataSource(data=dict(x=[], y=[])))
+    overlayLine = plot.line('x', 'y', source=overlaySources[i], line_width=2,
+                            line_alpha=0.8, color=Category10[10][i % 10], 
+                            visible=False)
+    overlayItems.append(LegendItem(label=columnNames[i], 
+                                   renderers=[overlayLine]))
+overlayLegend = Legend(items=[], location="top_left")
+plot.add_layout(overlayLegend)
+
+# Send the browser only the changes to the lines' data
+counterUpdate = SourceUpdater(source)
+overlayUpdates = [SourceUpdater(s) for s in overlaySources]
 
 # Widgets section
 
@@ -255,73 +267,191 @@ WeatherBoxes = CheckboxButtonGroup(labels = [emoji.emojize(':sunny: :cloud:', us
 RainSlider = RangeSlider(title="Inches of Rain per Day", start = 0, end = 2.5, 
                          value = (0,2.5), step = 0.05, format = "0.00")
 
-# Set up callbacks
-def update_data(attrname, old, new):
+# Show the counter selected above, or overlay the counters selected below
+DisplayButtons = RadioButtonGroup(labels = ["Single counter", "Overlay"], 
+                                  active = 0)
+
+OverlayBoxes = CheckboxButtonGroup(labels = counterNames, 
+                                   active = [counterNames.index(name) for name in 
+                                             ["2nd Ave", "Burke Gilman Trail", 
+                                              "Fremont Bridge"]])
+
+# Normalized counts are a percentage of each counter's peak in the view
+ScaleButtons = RadioButtonGroup(labels = ["Absolute", "Normalized"], 
+                                active = 0)
+
+def computeView(view, filters):
+    # Return the x values plotted for a view, and the y values of every 
+    # counter (one column each, as in histDF), where filters holds the keyword
+    # arguments of filterMask for the current widget state. All counters are
+    # aggregated in the same pass, so switching counters reuses the result.
+    # Results are LevelOfDetail pyramids: the Historical view has weekly,
+    # daily and hourly levels, the other views only the one level they plot.
+    
+    if view in ["Day", "Week"]: # Reductions over the pre-aggregated cube
+        mask = filterMask(countCube, **filters)
+        with timed("aggregate"):
+            if view == "Week":
+                mydf = cubeWeek(countCube, mask)
+            else: # Day view
+                mydf = cubeDay(countCube, mask)
+        
+        x =  np.array(mydf.index)*1000*60*60 # Convert ms to hours
+    else: # Historical and yearly views need the hourly rows in date order
+        # Generate the new dataframe from a single mask over the filter index
+        mydf = histDF[filterMask(filterIndex, **filters)]
+
+        with timed("aggregate"):
+            if view == "Historical":
+                return buildPyramid(mydf, HistoricalView(df = mydf))
+            else: # Year view has counts by week
+                mydf = TypicalYear(df = mydf)
+            x = np.array(mydf.index)*1000*60*60*24*7 # Convert ms to weeks        
+    
+    return {"x0": np.asarray(x, dtype = float), "Y0": mydf.values.astype(float)}
 
-    # Get the current slider values
-    view = ViewDropdown.value
-    counter = counterDict[CounterDropdown.value]
-    start = YearBoxes.active[0] + 2012
-    end = YearBoxes.active[-1] + 2012
-    months = MonthBoxes.active
-    weekdays = WeekdayBoxes.active
-    hours = np.round(HourSlider.value)
-    weather = WeatherBoxes.active
-    light = DaylightSlider.value
-    rain = RainSlider.value
-
-    # Translate weather list of ints to list of strings, eg ["Fog", "Rain"]
-    weatherList = []
-    for i in weather: weatherList.append(weatherDict[i])
-
-    # Convert start and end from ints to datetime 
-    # due to Bokeh bug: https://github.com/bokeh/bokeh/issues/6895#event-1242295796
-    yearRange = list(range(start, end + 1))
-
-    # Generate the new dataframe
-    mydf = histDF.copy(deep = True)
-    mydf = mydf.loc[mydf.index.year.isin(yearRange)] # Subset dates 
-    mydf = mydf[mydf.index.month.isin(months)] # Subset months
-    mydf = mydf[mydf.index.weekday.isin(weekdays)] # Subset weekdays 
-    mydf = subsetHours(start = hours[0], end = hours[1], df = mydf) # Subset hours
-    mydf = subsetDaylight(df = mydf, low = light[0], high = light[1])
-    mydf = subsetWeather(weatherList, df = mydf)
-    mydf = subsetRain(df = mydf, low = rain[0], high = rain[1])
+def selectCounter(view, x, Y, counter, normalize = False):
+    # Return the x and y values of one counter's line from computeView output
+    y = Y[:, counter]
+    
+    if view == "Historical":
+        # Start line at first non-null index
+        valid = np.flatnonzero(~np.isnan(y))
+        if len(valid): 
+            x, y = x[valid[0]:], y[valid[0]:]
+    
+    if normalize and len(y) and np.nanmax(y) > 0:
+        y = 100*y/np.nanmax(y)
+    
+    return x, y
 
+# Set up callbacks
+def readState():
 
-    if view == "Historical":
-        mydf = HistoricalView(df = mydf)   
+    # Get the current slider values
+    if YearBoxes.active: 
+        start = YearBoxes.active[0] + 2012
+        end = YearBoxes.active[-1] + 2012
+
+        # Convert start and end from ints to datetime 
+        # due to Bokeh bug: https://github.com/bokeh/bokeh/issues/6895#event-1242295796
+        yearRange = list(range(start, end + 1))
+    else: # No years selected: an empty view
+        yearRange = []
+
+    if DisplayButtons.active == 1:
+        overlay = sorted(counterDict[counterNames[i]] for i in OverlayBoxes.active)
+    else:
+        overlay = []
+    
+    return dict(view = ViewDropdown.value,
+                counter = counterDict[CounterDropdown.value],
+                overlay = overlay,
+                normalize = ScaleButtons.active == 1,
+                years = yearRange,
+                months = list(MonthBoxes.active),
+                weekdays = list(WeekdayBoxes.active),
+                hours = tuple(np.round(HourSlider.value)),
+                light = tuple(DaylightSlider.value),
+                weather = list(WeatherBoxes.active),
+                rain = tuple(RainSlider.value),
+                window = (plot.x_range.start, plot.x_range.end))
+
+def computeState(state):
+    # Runs in a worker thread. Serve repeated widget states from the 
+    # process-wide cache, and compute the others. Results hold every counter,
+    # so they are cached regardless of which counters are displayed.
+    filters = dict(state)
+    view = filters.pop("view")
+    for k in ["counter", "overlay", "normalize", "window"]: filters.pop(k)
+    
+    key = dashboardKey(view, None, **filters)
+    with labelled(view = view), timed("compute"):
+        result = resultCache.get(cacheName, key)
+        if result is None:
+            result = computeView(view, filters)
+            resultCache.put(cacheName, key, result)
+    return dict(result, state = state)
+
+# View currently plotted, the x range last set or answered by showResult, 
+# and the last x range it fitted to the data (i.e. zoomed all the way out)
+shownView = None
+shownWindow = None
+fittedWindow = None
+
+def showResult(result):
+    # Pick the displayed counters out of the aggregate for all of them, at
+    # the level of detail that fits the visible part of the Historical view
+    global shownView, shownWindow, fittedWindow
+    state = result["state"]
+    view = state["view"]
+    
+    # Keep the zoom while the Historical view stays up, unless it has been
+    # panned away from the data entirely; otherwise show all of the data,
+    # as weekly sums
+    window = state["window"]
+    x0 = result["x0"]
+    if (view != "Historical" or shownView != "Historical" or not len(x0) or
+            window == fittedWindow or window[1] < x0[0] or window[0] > x0[-1]):
+        window = None
+    level = 0 if window is None else pickLevel(result, window)
+    x, Y = result["x%d" % level], result["Y%d" % level]
+    
+    def line(counter):
+        cx, cy = selectCounter(view, x, Y, counter, state["normalize"])
+        return levelOfDetail(cx, cy, window)
+    
+    with timed("source_update", view = view):
+        if not state["overlay"]: # Single counter
+            x1, y1 = line(state["counter"])
+            counterUpdate.update(dict(x=x1, y=y1))
+        else:
+            counterUpdate.update(dict(x=[], y=[]))
+        counterLine.visible = not state["overlay"]
         
-        # Start dataframe at first non-null index
-        first = mydf.iloc[:, counter].first_valid_index()
-        mydf = mydf.loc[first: mydf.index[-1]]
-        x = mydf.index
-        #x = np.array(mydf.index)*1000*60*60*24*7 # Convert ms to weeks
-    else: # For weekly and daily views, which have counts by hour
-        if view == "Year": # Year view has counts by week
-            mydf = TypicalYear(df = mydf)
-            x = np.array(mydf.index)*1000*60*60*24*7 # Convert ms to weeks        
-        else: 
-            if view == "Week":
-                mydf = TypicalWeek(df = mydf)
-            else: # Day view
-                mydf = TypicalDay(df = mydf)
-            
-            x =  np.array(mydf.index)*1000*60*60 # Convert ms to hours
+        for i, item in enumerate(overlayItems):
+            shown = i in state["overlay"]
+            if shown:
+                x1, y1 = line(i)
+                overlayUpdates[i].update(dict(x=x1, y=y1))
+            else:
+                overlayUpdates[i].update(dict(x=[], y=[]))
+            item.renderers[0].visible = shown
+    overlayLegend.items = [overlayItems[i] for i in state["overlay"]]
     
-    y = mydf.iloc[:, counter].astype(float)
-   
-    source.data = dict(x=x, y=y)
+    if window is None and len(x0): # Fit the x range to the data, with padding
+        pad = 0.05*(x0[-1] - x0[0]) or 1
+        shownWindow = fittedWindow = (x0[0] - pad, x0[-1] + pad)
+        plot.x_range.start, plot.x_range.end = shownWindow
+    else:
+        shownWindow = window
+    shownView = view
+
+# Widget callback: coalesces rapid changes (e.g. slider drags) and computes
+# the latest state off the server's IO loop
+update_data = DebouncedCallback(curdoc(), readState, computeState, showResult)
     
 for w in [ViewDropdown, HourSlider, DaylightSlider, RainSlider, CounterDropdown]:
     w.on_change('value', update_data)
     
-for z in [YearBoxes, MonthBoxes, WeekdayBoxes, WeatherBoxes]:
+for z in [YearBoxes, MonthBoxes, WeekdayBoxes, WeatherBoxes, DisplayButtons, 
+          OverlayBoxes, ScaleButtons]:
     z.on_change('active', update_data)
 
+def update_window(attr, old, new):
+    # Pan and zoom callback: fetch the detail for the new x range of the
+    # Historical view. Changes made by showResult itself are ignored.
+    ownChange = shownWindow and new == shownWindow[attr == 'end']
+    if ViewDropdown.value == "Historical" and not ownChange:
+        update_data(attr, old, new)
+
+for a in ['start', 'end']:
+    plot.x_range.on_change(a, update_window)
+
 # Set up layouts and add to document
 inputs = widgetbox(ViewDropdown, CounterDropdown, YearBoxes, MonthBoxes, WeekdayBoxes, 
-                   HourSlider, DaylightSlider, WeatherBoxes, RainSlider)
+                   HourSlider, DaylightSlider, WeatherBoxes, RainSlider,
+                   DisplayButtons, OverlayBoxes, ScaleButtons)
 
 
 lay = layout([
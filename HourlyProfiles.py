@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+from Counters import counters, measured, addDerived, firstRow
+
+# Hourly forecasts from the daily ones, by hour-of-week profiles.
+#
+# Fitting hourly models would take far longer than the daily ones, while the
+# way a day's riding is spread over its hours depends mostly on the weekday,
+# the season and the weather. The profiles hold, for every counter, weekday
+# and weather condition, the share of the day's count that falls in each
+# hour, pooled over the history in histDF:
+#
+#   profiles[counter, weekday, hour, condition]
+#
+# as float32, with counters in registry order (the Total last) and
+# condition = weatherClass * len(seasons) + season. A cell with no history
+# (e.g. snow in summer) uses the counter's profile of that weekday over all
+# conditions. Splitting a week of daily forecasts into hours is then one
+# indexing operation and one multiply.
+
+# Daily rainfall classes, by their upper bounds in inches
+weatherClasses = ["Dry", "Showers", "Rain"]
+rainBounds = [0.005, 0.1] # Dry: none recorded, Showers: under a tenth inch
+
+# Seasons by month, Jan - Dec
+seasons = ["Winter", "Spring", "Summer", "Fall"]
+monthSeason = np.array([0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3, 0])
+
+conditionCount = len(weatherClasses) * len(seasons)
+
+def conditions(dates, precip):
+    # Condition number of each date, from its rainfall in inches
+    months = pd.DatetimeIndex(dates).month.values
+    rain = np.searchsorted(rainBounds, np.nan_to_num(np.asarray(precip, dtype = float)),
+                           side = 'right')
+    return rain * len(seasons) + monthSeason[months - 1]
+
+def conditionName(condition):
+    return "%s %s" % (weatherClasses[condition // len(seasons)],
+                      seasons[condition % len(seasons)])
+
+def buildProfiles(histDF, weatherDF):
+    # Profiles of every registry counter from the hourly counts and the
+    # daily weather
+    hourly = addDerived(histDF[[c.column for c in measured()]])
+    days = hourly.index.normalize()
+    weather = weatherDF["Precip"].copy()
+    weather.index = pd.DatetimeIndex(weather.index)
+    precip = weather.reindex(days).values
+    condition = conditions(days, precip)
+    weekday = hourly.index.weekday.values
+    hour = hourly.index.hour.values
+    cell = (weekday * 24 + hour) * conditionCount + condition
+
+    profiles = np.zeros((len(counters), 7, 24, conditionCount), dtype = np.float32)
+    for i, c in enumerate(counters):
+        values = hourly[c.column].values.astype(float)
+        valid = ~np.isnan(values)
+        valid[:firstRow(hourly.index, c)] = False
+        sums = np.bincount(cell[valid], weights = values[valid],
+                           minlength = 7 * 24 * conditionCount).reshape(7, 24, conditionCount)
+        daily = sums.sum(axis = 1, keepdims = True) # Count of each weekday and condition
+        pooled = sums.sum(axis = 2, keepdims = True) # Over all conditions
+        pooled = pooled / np.maximum(pooled.sum(axis = 1, keepdims = True), 1)
+        profiles[i] = np.where(daily > 0, sums / np.maximum(daily, 1), pooled)
+    return profiles
+
+def hourlyForecast(profiles, dates, daily, precip):
+    # Expected counts by hour, shaped (dates, counters, 24), from the daily
+    # forecasts (dates x counters, in registry order) and the forecast
+    # rainfall of each date in inches
+    weekday = pd.DatetimeIndex(dates).weekday.values
+    shares = profiles[:, weekday, :, conditions(dates, precip)] # dates x counters x hours
+    return np.asarray(daily, dtype = float)[:, :, None] * shares
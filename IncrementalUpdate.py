@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import PullData
+from Counters import measured, referenceCounter, columnAliases, standardColumns, \
+    addDerived, feedView, portal
+from FeedParser import feedFrame
+from Snapshot import dataDir, datasets, readCSV
+
+# Incremental refresh of histDF.csv and predictorsDF.csv.
+#
+# The full refresh (PullData.updateHistDF and updatePredictorsDF) downloads
+# every feed back to 2012 and rewrites both files. This one asks the portal's
+# query API only for the rows after each counter's last reading:
+#
+#   /resource/<view>.json?$where=date > '2017-11-30T23:00:00'&$order=date
+#
+# New hours of the reference counter are appended to histDF.csv, and missing
+# counts of earlier hours filled in. The days from the first changed hour on
+# are then recomputed as the full refresh would: missing counts imputed,
+# summed by day, the Total added and the weather joined. Those rows of
+# predictorsDF.csv are replaced. Both files keep their earlier lines as they
+# were, and only their tails are rewritten.
+#
+# The state is kept in ingestState.json next to the CSVs: the time of each
+# counter's last reading, the field names of its feed, and the imputation
+# ratios. It is rebuilt from histDF.csv when missing or when histDF.csv no
+# longer ends where it says (e.g. after a full refresh). The defective
+# stretches markNulls nulls and the reference counts it fills, all by hand,
+# are left to the full refresh.
+#
+#     python IncrementalUpdate.py [--portal http://localhost:8001]
+
+log = logging.getLogger(__name__)
+
+stateFile = "ingestState.json"
+pageSize = 50000 # Rows per request to the query API
+timeFormat = '%Y-%m-%dT%H:%M:%S'
+
+def csvPath(directory, name):
+    return os.path.join(directory, datasets[name]["csv"])
+
+def lastReadings(histDF):
+    # Time of each counter's last reading, or None
+    last = {}
+    for c in measured():
+        valid = histDF.index[histDF[c.column].notnull().values]
+        last[c.column] = valid[-1].strftime(timeFormat) if len(valid) else None
+    return last
+
+def newState(histDF):
+    return {"histEnd": histDF.index[-1].strftime(timeFormat),
+            "last": lastReadings(histDF),
+            "ratios": dict(zip(PullData.Counters, PullData.imputationRatios(histDF))),
+            "fields": {}}
+
+def loadState(directory, histDF):
+    try:
+        with open(os.path.join(directory, stateFile)) as f:
+            state = json.load(f)
+        if state["histEnd"] == histDF.index[-1].strftime(timeFormat): return state
+        log.info("histDF has changed since the last incremental update")
+    except (OSError, ValueError, KeyError):
+        pass
+    log.info("Building the ingest state from histDF")
+    return newState(histDF)
+
+def saveState(directory, state):
+    path = os.path.join(directory, stateFile)
+    temp = "%s.%d" % (path, os.getpid())
+    with open(temp, 'w') as output:
+        json.dump(state, output, indent = 1, sort_keys = True)
+    os.replace(temp, path)
+
+def getJSON(url):
+    with urllib.request.urlopen(url, timeout = PullData.feedTimeout) as response:
+        body = response.read()
+    return json.loads(body.decode()), len(body)
+
+def feedFields(base, counter):
+    # Field names of a counter's feed: the date, then the counts in feed order
+    meta, size = getJSON("%s/api/views/%s.json" % (base, feedView(counter)))
+    columns = sorted((c for c in meta["columns"] if not c["fieldName"].startswith(":")),
+                     key = lambda c: c["position"])
+    return [c["fieldName"] for c in columns]
+
+def getDelta(base, counter, fields, since):
+    # A counter's rows after `since`, as a feed frame (see FeedParser.feedFrame)
+    start = time.perf_counter()
+    date, countFields = fields[0], fields[1:]
+    records, size = [], 0
+    while True:
+        query = urllib.parse.urlencode({"$select": ",".join(fields),
+                                        "$where": "%s > '%s'" % (date, since),
+                                        "$order": date, "$limit": pageSize,
+                                        "$offset": len(records)})
+        page, pageBytes = getJSON("%s/resource/%s.json?%s" % (base, feedView(counter), query))
+        records.extend(page)
+        size += pageBytes
+        if len(page) < pageSize: break
+    dates = np.array([r.get(date) or "" for r in records], dtype = 'S19')
+    counts = np.array([[np.nan if r.get(f) is None else float(r[f]) for f in countFields]
+                       for r in records]).reshape(len(records), len(countFields))
+    log.info("New rows of %s: %d after %s, %.1f kB in %.1f s", counter.column, len(records),
+             since, size / 1e3, time.perf_counter() - start)
+    return feedFrame(dates.astype('datetime64[ns]'), counts)
+
+def getDeltas(base, state):
+    # New rows of every measured counter, by column
+    def fetch(c):
+        if c.column not in state["fields"]:
+            state["fields"][c.column] = PullData.retried(lambda: feedFields(base, c), c.column)
+        since = state["last"].get(c.column)
+        if since is None: # No readings yet
+            since = (datetime.combine(c.firstDate, datetime.min.time()) -
+                     timedelta(seconds = 1)).strftime(timeFormat)
+        return PullData.retried(lambda: getDelta(base, c, state["fields"][c.column], since),
+                                c.column)
+    with ThreadPoolExecutor(max_workers = PullData.feedWorkers) as pool:
+        return dict(zip(PullData.Counters, pool.map(fetch, measured())))
+
+def mergeDeltas(histDF, deltas):
+    # histDF with the new rows: hours after its end on the reference
+    # counter's timeline are appended, and counts of earlier hours filled
+    # in. Also returns the first hour that changed, or None.
+    series = {}
+    for column, df in deltas.items():
+        s = PullData.counterTotals(df, column)[column]
+        series[column] = s[~s.index.duplicated(keep = 'first')]
+    reference = series[referenceCounter]
+    newHours = reference.index[reference.index > histDF.index[-1]]
+    merged = pd.concat([histDF, pd.DataFrame(np.nan, index = newHours,
+                                             columns = histDF.columns)])
+    changed = list(newHours[:1])
+    for column, s in series.items():
+        s = s[s.index.isin(merged.index) & s.notnull().values]
+        if len(s) == 0: continue
+        merged.loc[s.index, column] = s.values
+        changed.append(s.index[0])
+    return merged, min(changed) if changed else None
+
+def imputedHours(hourly, ratios, start):
+    # Hours from start on with missing counts imputed as markNulls does for
+    # hours it has no fixes for: the other counters' by their ratio to the
+    # reference counter. Missing reference counts stay missing, as do the
+    # counts imputed from them.
+    hours = hourly[hourly.index >= start].copy()
+    for name in PullData.Counters:
+        nulls = hours[name].isnull()
+        hours.loc[nulls, name] = ratios[name] * hours.loc[nulls, referenceCounter]
+    return hours
+
+def predictorRows(hours, weatherDF):
+    # Rows of predictorsDF for the days of the hours, which are whole days
+    daily = addDerived(PullData.getDailyDF(hours[PullData.Counters]))
+    daily.index = daily.index.strftime('%Y-%m-%d')
+    predictors = daily.join(weatherDF, how = 'left')
+    predictors["logPrecip"] = np.log(pd.to_numeric(predictors["Precip"]) + 1)
+    return predictors
+
+def replaceTail(path, df, start, dateFormat):
+    # Replace the rows of a CSV from the time `start` on with df's, in the
+    # file's column order, spelling and line endings. Earlier lines are kept
+    # as they are.
+    with open(path, 'rb+') as f:
+        header = f.readline()
+        newline = "\r\n" if header.endswith(b"\r\n") else "\n"
+        names = header.decode().rstrip("\r\n").split(",")[1:]
+        key = start.strftime(dateFormat).encode()
+        offset = f.tell()
+        for line in iter(f.readline, b""):
+            if line[:len(key)] >= key: break
+            offset = f.tell()
+        text = df[[columnAliases.get(n, n) for n in names]].to_csv(
+            header = False, date_format = dateFormat)
+        f.seek(offset)
+        f.truncate()
+        f.write(text.replace("\n", newline).encode())
+
+def updateIncremental(directory = dataDir, base = portal):
+    # Bring histDF.csv and predictorsDF.csv in directory up to date with the
+    # portal at base. Returns the number of hours appended.
+    start = time.perf_counter()
+    histDF = standardColumns(readCSV("histDF", csvPath(directory, "histDF")))
+    state = loadState(directory, histDF)
+    deltas = getDeltas(base, state)
+
+    merged, changedFrom = mergeDeltas(histDF, deltas)
+    appended = len(merged) - len(histDF)
+    if changedFrom is not None:
+        replaceTail(csvPath(directory, "histDF"), merged[merged.index >= changedFrom],
+                    changedFrom, datasets["histDF"]["format"])
+
+        firstDay = changedFrom.normalize()
+        weatherDF = pd.read_csv(csvPath(directory, "weatherDF"), index_col = 0,
+                                float_precision = 'round_trip')
+        rows = predictorRows(imputedHours(merged, state["ratios"], firstDay), weatherDF)
+        replaceTail(csvPath(directory, "predictorsDF"), rows, firstDay,
+                    datasets["predictorsDF"]["format"])
+
+    state["histEnd"] = merged.index[-1].strftime(timeFormat)
+    state["last"] = lastReadings(merged)
+    saveState(directory, state)
+    log.info("Incremental update: %d new hours, %s in %.1f s", appended,
+             "days from %s recomputed" % changedFrom.date() if changedFrom is not None
+             else "nothing changed", time.perf_counter() - start)
+    return appended
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Add the counts since the last update")
+    parser.add_argument("--portal", default = portal, help = "base URL of the data portal")
+    parser.add_argument("--directory", default = dataDir, help = "directory of the CSVs")
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO)
+    updateIncremental(args.directory, args.portal)
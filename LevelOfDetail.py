@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+# Level-of-detail rendering for the Historical view.
+#
+# For each filter state, the filtered hourly counts are summarized once into
+# a pyramid of levels: weekly sums (as HistoricalView computes them), daily
+# sums and the raw hourly counts, for every counter. Whenever the visible x
+# range changes, the finest level that fits the point budget within that
+# range is sent to the browser, so the full history shows weekly totals and
+# zooming in reveals daily and then hourly detail. A level that still holds
+# too many points is thinned with min/max-preserving decimation, so peaks
+# and troughs survive.
+#
+# Pyramids are dicts holding the x values (ms since the epoch) and counts
+# (one column per counter) of level i under "x<i>" and "Y<i>", coarsest first.
+
+# Most points sent per counter and level
+maxPoints = 1500
+
+levelNames = ["week", "day", "hour"]
+
+def epochMs(index):
+    # Milliseconds since the epoch, as Bokeh's datetime axes expect
+    return pd.DatetimeIndex(index).asi8 / 1e6
+
+def dailySums(df):
+    # Sum hourly counts by day. Days on which a counter has no observations
+    # are NaN rather than zero, so lines break instead of dropping to zero.
+    days = df.index.values.astype('datetime64[D]')
+    keys, inverse = np.unique(days, return_inverse = True)
+    values = df.values.astype(float)
+    notnull = ~np.isnan(values)
+
+    Y = np.empty((len(keys), values.shape[1]))
+    for j in range(values.shape[1]):
+        sums = np.bincount(inverse, weights = np.where(notnull[:, j], values[:, j], 0),
+                           minlength = len(keys))
+        counts = np.bincount(inverse, weights = notnull[:, j], minlength = len(keys))
+        Y[:, j] = np.where(counts > 0, sums, np.nan)
+
+    return epochMs(keys), Y
+
+def buildPyramid(df, weekly):
+    # Build the levels for the filtered hourly dataframe df, given its
+    # weekly sums as computed by HistoricalView
+    xDay, YDay = dailySums(df)
+    return {"x0": np.asarray(weekly.index, dtype = float),
+            "Y0": weekly.values.astype(float),
+            "x1": xDay, "Y1": YDay,
+            "x2": epochMs(df.index), "Y2": df.values.astype(float)}
+
+def windowBounds(x, window):
+    # Index range of the points of sorted x inside window = (start, end),
+    # plus one point on either side so lines run to the plot edges
+    if window is None: return 0, len(x)
+    lo = max(np.searchsorted(x, window[0]) - 1, 0)
+    hi = min(np.searchsorted(x, window[1], side = 'right') + 1, len(x))
+    return lo, hi
+
+def pickLevel(pyramid, window):
+    # Finest level with at most maxPoints points inside the window
+    levels = len([k for k in pyramid if k.startswith("x")])
+    for level in reversed(range(levels)):
+        lo, hi = windowBounds(pyramid["x%d" % level], window)
+        if hi - lo <= maxPoints:
+            return level
+    return 0
+
+def decimate(x, y, limit = maxPoints):
+    # Thin a line to at most limit points, keeping the minimum and maximum
+    # of each run of consecutive points. NaNs are kept only where a whole
+    # run is missing.
+    n = len(x)
+    if n <= limit: return x, y
+
+    size = int(np.ceil(n / (limit // 2))) # Points per run
+    runs = int(np.ceil(n / size))
+    pad = runs*size - n
+    low = np.append(np.where(np.isnan(y), np.inf, y), [np.inf]*pad)
+    high = np.append(np.where(np.isnan(y), -np.inf, y), [-np.inf]*pad)
+
+    offsets = np.arange(runs)*size
+    keep = np.concatenate([offsets + low.reshape(runs, size).argmin(axis = 1),
+                           offsets + high.reshape(runs, size).argmax(axis = 1)])
+    keep = np.unique(np.minimum(keep, n - 1))
+    return x[keep], y[keep]
+
+def levelOfDetail(x, y, window):
+    # Return the part of a level's line inside the window, decimated to the
+    # point budget
+    lo, hi = windowBounds(x, window)
+    return decimate(x[lo:hi], y[lo:hi])
@@ -0,0 +1,262 @@
+import atexit
+import functools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+import numpy as np
+
+# Stage timings, session counts and cache statistics of the Bokeh apps.
+#
+# Hot stages are wrapped in timed(stage, **labels), which records how long
+# they took, by stage and labels, while metrics are enabled, and does nothing
+# otherwise. Labels set with labelled(**labels) (e.g. the dashboard's view)
+# apply to everything timed inside it, in the same thread. Each series keeps
+# a count, a total and its most recent durations, for the quantiles.
+#
+# Modules with statistics of their own (the result cache, the source
+# updaters) register collectors, which are read when the metrics are
+# rendered. The metrics are served in the Prometheus text format by a small
+# HTTP server thread in the Bokeh server process, and can be logged on exit.
+#
+# Configuration, by environment variable:
+#   BIKE_METRICS=1         enable the timings and the endpoint
+#   BIKE_METRICS_PORT=5007 port of the endpoint, next to bokeh serve's 5006
+#   BIKE_METRICS_DUMP=1    log the metrics when the process exits
+#
+#     BIKE_METRICS=1 bokeh serve HistoricalDashboard.py Predict.py
+#     curl localhost:5007/metrics
+
+log = logging.getLogger(__name__)
+
+enabled = os.environ.get("BIKE_METRICS", "0") not in ("", "0")
+port = int(os.environ.get("BIKE_METRICS_PORT", 5007))
+dumpOnExit = os.environ.get("BIKE_METRICS_DUMP", "0") not in ("", "0")
+
+prefix = "bikes_"
+samplesKept = 2048 # Most recent durations kept per series
+quantiles = (0.5, 0.95, 0.99)
+
+# Help text of the counters recorded with increment()
+helpTexts = {"sessions_total": "Bokeh sessions opened, by app",
+             "sessions_active": "Bokeh sessions open, by app"}
+
+lock = threading.Lock()
+series = {} # (stage, labels) -> Series
+counts = {} # (name, labels) -> value
+collectors = [] # Functions returning extra metrics, see addCollector
+context = threading.local()
+server = None
+
+class Series:
+
+    __slots__ = ("count", "total", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen = samplesKept)
+
+def enable(on = True):
+    global enabled
+    enabled = on
+
+def labelKey(labels):
+    return tuple(sorted(labels.items()))
+
+def record(stage, seconds, **labels):
+    # Add one duration to a stage's series
+    if not enabled: return
+    key = (stage, labelKey(dict(getattr(context, "labels", {}), **labels)))
+    with lock:
+        s = series.get(key)
+        if s is None: s = series[key] = Series()
+        s.count += 1
+        s.total += seconds
+        s.samples.append(seconds)
+
+def increment(name, value = 1, **labels):
+    # Add to a counter, e.g. of sessions; counted even while timings are off
+    key = (name, labelKey(labels))
+    with lock:
+        counts[key] = counts.get(key, 0) + value
+
+class Timer:
+
+    __slots__ = ("stage", "labels", "start")
+
+    def __init__(self, stage, labels):
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.stage, time.perf_counter() - self.start, **self.labels)
+        return False
+
+class Laps:
+    # Times consecutive steps of a stage: lap(step) records the time since
+    # the previous lap, with a step label
+
+    def __init__(self, stage, labels):
+        self.stage = stage
+        self.labels = labels
+        self.last = time.perf_counter()
+
+    def lap(self, step):
+        now = time.perf_counter()
+        record(self.stage, now - self.last, step = step, **self.labels)
+        self.last = now
+
+class NullTimer:
+    # Stands in for a Timer or Laps while metrics are disabled
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def lap(self, step):
+        pass
+
+nullTimer = NullTimer()
+
+def timed(stage, **labels):
+    # Context manager timing a stage
+    return Timer(stage, labels) if enabled else nullTimer
+
+def laps(stage, **labels):
+    return Laps(stage, labels) if enabled else nullTimer
+
+def timedFunction(stage, **labels):
+    # Decorator timing every call of a function as a stage
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled: return fn(*args, **kwargs)
+            with Timer(stage, labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+@contextmanager
+def labelled(**labels):
+    # Labels for everything timed inside, in this thread
+    outer = getattr(context, "labels", {})
+    context.labels = dict(outer, **labels)
+    try:
+        yield
+    finally:
+        context.labels = outer
+
+def addCollector(collect):
+    # collect() returns a list of (name, type, help, [(labels dict, value)])
+    # to include in the metrics, e.g. ("cache_hits_total", "counter", ...)
+    collectors.append(collect)
+
+def trackSession(doc, app):
+    # Count a Bokeh session of an app, and its end where Bokeh reports it
+    increment("sessions_total", app = app)
+    increment("sessions_active", app = app)
+    if hasattr(doc, "on_session_destroyed"):
+        doc.on_session_destroyed(lambda context: increment("sessions_active", -1, app = app))
+
+def formatLabels(labels):
+    if not labels: return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + "}"
+
+def render():
+    # All metrics, in the Prometheus text exposition format
+    with lock:
+        snapshot = [(key, s.count, s.total, np.array(s.samples))
+                    for key, s in sorted(series.items())]
+        counted = sorted(counts.items())
+
+    name = prefix + "stage_seconds"
+    lines = ["# HELP %s Duration of app stages, over the most recent %d of each" %
+             (name, samplesKept),
+             "# TYPE %s summary" % name]
+    for (stage, labels), count, total, samples in snapshot:
+        labels = (("stage", stage),) + labels
+        for q in quantiles:
+            lines.append("%s%s %.6g" % (name, formatLabels(labels + (("quantile", q),)),
+                                        np.percentile(samples, 100*q)))
+        lines.append("%s_sum%s %.6g" % (name, formatLabels(labels), total))
+        lines.append("%s_count%s %d" % (name, formatLabels(labels), count))
+
+    metrics = {}
+    for (metric, labels), value in counted:
+        kind = "counter" if metric.endswith("_total") else "gauge"
+        metrics.setdefault(metric, (kind, helpTexts.get(metric, metric), []))[2].append(
+            (dict(labels), value))
+    for collect in collectors:
+        try:
+            for metric, kind, text, values in collect():
+                metrics[metric] = (kind, text, values)
+        except Exception:
+            log.exception("Metrics collector failed")
+    for metric, (kind, text, values) in sorted(metrics.items()):
+        lines.append("# HELP %s%s %s" % (prefix, metric, text))
+        lines.append("# TYPE %s%s %s" % (prefix, metric, kind))
+        for labels, value in values:
+            lines.append("%s%s%s %.6g" % (prefix, metric, formatLabels(labelKey(labels)),
+                                          value))
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes are not worth logging
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serve(port = port, host = ""):
+    # Serve the metrics from a daemon thread, once per process. Returns the
+    # server, or None if the port is taken (e.g. by another server process).
+    global server
+    with lock:
+        if server is not None: return server
+        try:
+            server = MetricsServer((host, port), MetricsHandler)
+        except OSError as e:
+            log.warning("Metrics endpoint not started on port %d: %s", port, e)
+            return None
+    threading.Thread(target = server.serve_forever, daemon = True,
+                     name = "Metrics").start()
+    log.info("Serving metrics on port %d", server.server_address[1])
+    return server
+
+def dump():
+    log.info("Metrics at exit:\n%s", render())
+
+started = False
+
+def start():
+    # Called by every app; starts the endpoint and the exit dump the first
+    # time while metrics are enabled
+    global started
+    if not enabled or started: return
+    started = True
+    serve()
+    if dumpOnExit: atexit.register(dump)
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+import numpy as np
+from FastForecast import modelParams
+from Counters import counters
+from Metrics import timed
+
+# Compact model artifacts, loaded lazily.
+#
+# A pickled Prophet model holds its training history and needs the Prophet
+# and pandas versions it was pickled with, while forecasting only needs a few
+# dozen numbers. Each model's parameters (see FastForecast.modelParams) are
+# therefore also stored as Models<i>.json, next to Models<i>.pkl:
+#
+#   {"version": 2,
+#    "source": {"sha1": <hash of the pickle it was exported from>},
+#    "params": {"start": ..., "tScale": ..., "yScale": ..., "k": ...,
+#               "m": ..., "delta": [...], "changepoints": [...],
+#               "beta": [...], "sigmaObs": ..., "intervalWidth": ...,
+#               "seasonalities": [[name, period, order]],
+#               "regressors": [[name, mu, std]]}}
+#
+# A ModelStore loads each artifact on first use. It falls back to the pickle,
+# and rewrites the artifact, when the artifact is missing, was written by
+# another artifact version, or no longer matches its pickle.
+#
+# Usage, to export the artifacts of the current pickles:
+#     python ModelArtifacts.py
+
+artifactVersion = 2
+
+# Models are stored next to the apps, as Models<column number>.pkl and .json
+modelDir = os.path.dirname(os.path.realpath(__file__))
+modelCount = len(counters) # One model per counter, with the Total
+
+def modelPath(i, folder = modelDir):
+    return os.path.join(folder, 'Models' + str(i) + '.pkl')
+
+def artifactPath(i, folder = modelDir):
+    return os.path.join(folder, 'Models' + str(i) + '.json')
+
+def fileHash(path):
+    # SHA-1 of a file's contents, or None if there is no such file
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+def loadPickle(i, folder = modelDir):
+    # The full Prophet model, as fitted
+    with open(modelPath(i, folder), 'rb') as f:
+        return pickle.load(f)
+
+def writeArtifact(i, params, source, folder = modelDir):
+    # Write a model's parameters, replacing its artifact atomically
+    params = {k: v.tolist() if isinstance(v, np.ndarray) else v
+              for k, v in params.items()}
+    path = artifactPath(i, folder)
+    temp = path + '.%d' % os.getpid()
+    with open(temp, 'w') as output:
+        json.dump({"version": artifactVersion, "source": source,
+                   "params": params}, output, indent = 1)
+    os.replace(temp, path)
+
+def exportArtifact(i, model, folder = modelDir):
+    # Export the artifact of a model whose pickle has been written
+    writeArtifact(i, modelParams(model), {"sha1": fileHash(modelPath(i, folder))},
+                  folder)
+
+def readArtifact(i, folder = modelDir):
+    # A model's parameters, or None if its artifact is missing, from another
+    # artifact version, or exported from another pickle than the current one
+    try:
+        with open(artifactPath(i, folder)) as f:
+            artifact = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if artifact.get("version") != artifactVersion:
+        return None
+    source = fileHash(modelPath(i, folder))
+    if source is not None and artifact["source"].get("sha1") != source:
+        return None
+
+    params = artifact["params"]
+    for k in ["delta", "changepoints", "beta"]:
+        params[k] = np.array(params[k], dtype = float)
+    params["seasonalities"] = [tuple(s) for s in params["seasonalities"]]
+    params["regressors"] = [tuple(r) for r in params["regressors"]]
+    return params
+
+class ModelStore:
+    # Models by column number, loaded on first use and kept after that.
+    # store.params(i) is model i's forecasting parameters, from its artifact;
+    # store[i] is the full Prophet model, from its pickle, for plotting.
+
+    def __init__(self, folder = modelDir, count = modelCount):
+        self.folder = folder
+        self.count = count
+        self.models = {}
+        self.paramsCache = {}
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count: raise IndexError(i)
+        with self.lock:
+            if i not in self.models:
+                with timed("model_load", kind = "pickle"):
+                    self.models[i] = loadPickle(i, self.folder)
+            return self.models[i]
+
+    def params(self, i):
+        if not 0 <= i < self.count: raise IndexError(i)
+        with self.lock:
+            if i in self.paramsCache: return self.paramsCache[i]
+        with timed("model_load", kind = "artifact"):
+            params = readArtifact(i, self.folder)
+        if params is None: # Fall back to the pickle, and export it for next time
+            model = self[i]
+            params = modelParams(model)
+            try:
+                exportArtifact(i, model, self.folder)
+            except OSError:
+                pass # Read-only checkout; the pickle is used every time
+        with self.lock:
+            self.paramsCache[i] = params
+        return params
+
+    def version(self, i):
+        # Hash of model i's pickle, which changes whenever it is refitted.
+        # It is hashed again when the pickle's size or modification time
+        # changes (e.g. after ModelTraining), and the model and parameters
+        # loaded from the old pickle are dropped.
+        path = modelPath(i, self.folder)
+        try:
+            stat = os.stat(path)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            stamp = None
+        with self.lock:
+            if i in self.versions and self.versions[i][0] == stamp:
+                return self.versions[i][1]
+            if i in self.versions:
+                self.models.pop(i, None)
+                self.paramsCache.pop(i, None)
+            self.versions[i] = (stamp, fileHash(path))
+            return self.versions[i][1]
+
+    def allParams(self):
+        return [self.params(i) for i in range(self.count)]
+
+def exportAll(folder = modelDir, count = modelCount):
+    # Export the artifacts of every pickled model
+    for i in range(count):
+        exportArtifact(i, loadPickle(i, folder), folder)
+
+if __name__ == "__main__":
+    exportAll()
+    for i in range(modelCount):
+        print("Model %d: %6d bytes pickled, %5d bytes as an artifact" %
+              (i, os.path.getsize(modelPath(i)), os.path.getsize(artifactPath(i))))
+    start = time.perf_counter()
+    ModelStore().allParams()
+    print("Loaded all artifacts in %.1f ms" % (1000*(time.perf_counter() - start)))
@@ -0,0 +1,235 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sys
+import time
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from ModelArtifacts import modelDir, modelCount, modelPath, exportArtifact, ModelStore
+from Counters import firstRow
+
+# Parallel training of the Prophet models behind Predict.py.
+#
+# There is one model per counter in the registry (Counters.py), numbered by
+# its column in predictorsDF, and each fit is an independent Stan
+# optimization, so the models are fitted in a pool of worker processes, one
+# per core by default. Each model is handed to a callback as soon as its fit
+# completes (CreatePickleModels writes it to disk there, with its compact
+# artifact), and a model that fails to fit is reported without stopping the
+# others.
+#
+# Incremental retraining, for the monthly data refresh, skips the counters
+# whose training data has not changed since their last fit, and starts the
+# optimization of the others from their previous parameters rather than from
+# Prophet's default initialization. A manifest next to the models records the
+# hash of each model's training data and how long its fits took.
+#
+# Usage, after the monthly data refresh:
+#     python ModelTraining.py [--incremental] [--compare-cold] [--processes N]
+
+log = logging.getLogger(__name__)
+
+manifestPath = os.path.join(modelDir, "trainingManifest.json")
+
+def trainingFrame(predictorsDF, i):
+    # Training data for the model of column i, starting on the first valid
+    # date of its counter in the registry
+    k = firstRow(predictorsDF.index, predictorsDF.columns[i])
+
+    return pd.DataFrame(data = {'ds': predictorsDF.index[k:], # dates
+                                'y': predictorsDF.iloc[k:, i], # Counts
+                                'logPrecip': predictorsDF['logPrecip'][k:], # log of rainfall in inches
+                                'TempHi': predictorsDF['TempHi'][k:],  # Daily high temperature, Fahrenheit
+                                'cap': max(predictorsDF.iloc[k:, i]),
+                                'floor': min(predictorsDF.iloc[k:, i])}) # Maximum value = maximum observed in dataset
+
+def trainingHash(df):
+    # Content hash of a training frame, dates and values included
+    values = pd.util.hash_pandas_object(df, index = False).values
+    return hashlib.sha1(values.tobytes()).hexdigest()
+
+def warmStart(params, df):
+    # Stan initialization for fitting df, from a previous fit's parameters.
+    # Prophet scales y by its maximum and t by the span of the history, so
+    # the previous parameters are rescaled to the new data's scales. Returns
+    # None if the previous model's shape does not fit the new one.
+    if params is None: return None
+    yScale = np.abs(df['y']).max()
+    tScale = (pd.to_datetime(df['ds']).max() - pd.to_datetime(df['ds']).min()).days
+    if not yScale or not tScale: return None
+    y = params["yScale"] / yScale
+    t = tScale / params["tScale"]
+    return {"k": params["k"] * y * t,
+            "m": params["m"] * y,
+            "delta": np.asarray(params["delta"]) * y * t,
+            "beta": np.asarray(params["beta"]) * y,
+            "sigma_obs": params.get("sigmaObs", 1.0) * y}
+
+def newModel():
+    from fbprophet import Prophet
+
+    m = Prophet(growth='linear', yearly_seasonality=True, daily_seasonality = False,
+                weekly_seasonality = True)
+    m.add_regressor('logPrecip')
+    m.add_regressor('TempHi')
+    return m
+
+def fitModel(i, df, init = None):
+    # Fit one model in a worker process, from Prophet's default
+    # initialization or from init. Returns the column number, the fitted
+    # model, the fit time in seconds and whether the fit was warm started.
+    start = time.perf_counter()
+    if init is not None:
+        try:
+            m = newModel()
+            m.fit(df, init = init)
+            return i, m, time.perf_counter() - start, True
+        except Exception: # e.g. the number of changepoints changed
+            log.exception("Warm start of model %d failed, fitting it cold", i)
+    m = newModel()
+    m.fit(df)
+    return i, m, time.perf_counter() - start, False
+
+def readManifest(path = manifestPath):
+    # Training record of each model, by column number
+    try:
+        with open(path) as f:
+            return {int(i): entry for i, entry in json.load(f).items()}
+    except (OSError, ValueError):
+        return {}
+
+def writeManifest(manifest, path = manifestPath):
+    temp = path + '.%d' % os.getpid()
+    with open(temp, 'w') as output:
+        json.dump({str(i): manifest[i] for i in sorted(manifest)}, output, indent = 1)
+    os.replace(temp, path)
+
+def writeModel(i, model, folder = modelDir):
+    # Replace the stored model and its artifact atomically, so a server
+    # loading the models never reads a partly written file
+    path = modelPath(i, folder)
+    temp = path + '.%d' % os.getpid()
+    with open(temp, 'wb') as output:
+        pickle.dump(model, output, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp, path)
+    exportArtifact(i, model, folder)
+
+def trainModels(predictorsDF, columns = range(modelCount), processes = None,
+                onModel = None, incremental = False, compareCold = False,
+                store = None, manifest = manifestPath):
+    # Fit the models of the given columns in parallel. onModel(i, model) is
+    # called in this process as each fit completes. Returns the models by
+    # column number (None where the fit failed or was skipped) and a timing
+    # report.
+    # When incremental, models whose training data is unchanged are skipped,
+    # and the others are warm started from their stored parameters (store,
+    # a ModelStore). compareCold also runs a cold fit of each warm started
+    # model, for timing only. The manifest file, if any, records every fit.
+    start = time.perf_counter()
+    columns = list(columns)
+    models = {i: None for i in columns}
+    report = {"models": {}, "processes": processes or os.cpu_count()}
+    if onModel is None: manifest = None # Nothing is stored, so nothing is recorded
+    record = readManifest(manifest) if manifest else {}
+    if incremental and store is None: store = ModelStore()
+
+    with ProcessPoolExecutor(max_workers = report["processes"]) as pool:
+        futures = {}
+        for i in columns:
+            df = trainingFrame(predictorsDF, i)
+            entry = {"column": predictorsDF.columns[i], "rows": len(df),
+                     "hash": trainingHash(df), "seconds": None,
+                     "coldSeconds": record.get(i, {}).get("coldSeconds")}
+            report["models"][i] = entry
+
+            init = None
+            if incremental:
+                if record.get(i, {}).get("hash") == entry["hash"]:
+                    entry.update(status = "unchanged", mode = "skipped")
+                    continue
+                try:
+                    init = warmStart(store.params(i), df)
+                except Exception as e: # No usable previous model: fit cold
+                    log.warning("No previous parameters for model %d: %s", i, e)
+            entry["mode"] = "cold" if init is None else "warm"
+            futures[pool.submit(fitModel, i, df, init)] = (i, entry["mode"])
+            if compareCold and init is not None:
+                futures[pool.submit(fitModel, i, df)] = (i, "compare")
+
+        for future in as_completed(futures):
+            i, mode = futures[future]
+            entry = report["models"][i]
+            try:
+                _, model, seconds, warm = future.result()
+            except Exception as e:
+                if mode != "compare":
+                    entry.update(status = "failed", error = "%s: %s" % (type(e).__name__, e))
+                log.exception("Fitting model %d (%s) failed", i, entry["column"])
+                continue
+
+            if mode == "compare": # Timing only
+                entry["coldSeconds"] = seconds
+                if manifest and i in record: record[i]["coldSeconds"] = seconds
+            else:
+                mode = "warm" if warm else "cold"
+                entry.update(status = "ok", seconds = seconds, mode = mode)
+                if mode == "cold": entry["coldSeconds"] = seconds
+                models[i] = model
+                try:
+                    if onModel is not None: onModel(i, model)
+                except Exception as e:
+                    entry.update(status = "failed", error = "%s: %s" % (type(e).__name__, e))
+                    log.exception("Storing model %d (%s) failed", i, entry["column"])
+                    continue
+                record[i] = {"hash": entry["hash"], "rows": entry["rows"],
+                             "fitted": datetime.now().isoformat(timespec = 'seconds'),
+                             "mode": mode, "seconds": seconds,
+                             "coldSeconds": entry["coldSeconds"]}
+                log.info("Model %d (%s): %s fit in %.2f s", i, entry["column"], mode, seconds)
+            if manifest: writeManifest(record, manifest)
+
+    report["seconds"] = time.perf_counter() - start
+    report["fitSeconds"] = sum(e["seconds"] for e in report["models"].values()
+                               if e["seconds"] is not None)
+    return models, report
+
+def formatReport(report):
+    # Per-model timing table, with the latest cold fit time of each model for
+    # comparison, and the total time against the sum of fit times
+    def seconds(s):
+        return "%9.2f" % s if s is not None else "%9s" % "-"
+
+    lines = ["%-6s %-10s %7s %-7s %9s %9s  %s" % ("Model", "Column", "Rows", "Mode",
+                                                 "Seconds", "Cold", "Status")]
+    for i in sorted(report["models"]):
+        e = report["models"][i]
+        lines.append("%-6d %-10s %7d %-7s %s %s  %s" % (i, e["column"], e["rows"],
+                                                       e.get("mode", "-"),
+                                                       seconds(e["seconds"]),
+                                                       seconds(e["coldSeconds"]),
+                                                       e.get("error", e.get("status", "-"))))
+    lines.append("%d processes: %.2f s total for %.2f s of fitting" %
+                 (report["processes"], report["seconds"], report["fitSeconds"]))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    from SharedData import getPredictorsDF
+    parser = argparse.ArgumentParser(description = "Fit the Predict.py models")
+    parser.add_argument("--incremental", action = "store_true",
+                        help = "skip unchanged counters, and warm start the others")
+    parser.add_argument("--compare-cold", action = "store_true",
+                        help = "also time a cold fit of each warm started model")
+    parser.add_argument("--processes", type = int, default = None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+    models, report = trainModels(getPredictorsDF(), processes = args.processes,
+                                 onModel = writeModel, incremental = args.incremental,
+                                 compareCold = args.compare_cold)
+    print(formatReport(report))
+    sys.exit(any(e.get("status") == "failed" for e in report["models"].values()))
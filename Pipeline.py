@@ -0,0 +1,248 @@
+import argparse
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import time
+import numpy as np
+import pandas as pd
+import PullData
+from Counters import addDerived
+from Metrics import timed
+from Snapshot import dataDir, sourceStamp
+
+# The full data refresh as a pipeline of cached stages:
+#
+#   fetch      download the feeds (PullData.getRawData)
+#   normalize  each counter's bike totals
+#   merge      one hourly frame on the reference counter's timeline: histDF
+#   impute     defective and missing counts replaced (markNulls)
+#   daily      summed by day, with the Total
+#   weather    joined with weatherDF.csv: predictorsDF
+#   write      histDF.csv and predictorsDF.csv
+#
+# Each stage's output is pickled in pipelineCache/, under a key hashed from
+# the stage's name, the source code it runs and the content hashes of its
+# inputs. A stage whose key is cached is skipped, and its output is only
+# loaded if a later stage has to run, so a refresh whose feeds have not
+# changed downloads them and stops there. Within a refresh every stage runs
+# at most once.
+#
+# The downloaded feeds are reused for fetchAge seconds, so updateHistDF
+# followed by updatePredictorsDF downloads once. The write stage is skipped
+# while the files it wrote are unchanged.
+#
+#     python Pipeline.py [--refetch] [--no-write] [--clear]
+#
+# prints the status and time of each stage.
+
+log = logging.getLogger(__name__)
+
+cacheDir = os.path.join(dataDir, "pipelineCache")
+fetchAge = 3600 # Seconds the downloaded feeds are reused for
+entriesKept = 2 # Cached outputs kept per stage
+
+def contentHash(value):
+    # Hash of a value's content: frames by their values, index, columns and
+    # dtypes, containers by their items
+    h = hashlib.sha1()
+    def add(value):
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            h.update(repr((type(value).__name__, list(getattr(value, "columns", [])),
+                           [str(t) for t in np.atleast_1d(value.dtypes)])).encode())
+            h.update(pd.util.hash_pandas_object(value, index = True).values.tobytes())
+        elif isinstance(value, (list, tuple)):
+            h.update(b"[%d" % len(value))
+            for item in value: add(item)
+        elif isinstance(value, dict):
+            h.update(b"{%d" % len(value))
+            for k in sorted(value): add(k); add(value[k])
+        else:
+            h.update(repr(value).encode())
+    add(value)
+    return h.hexdigest()
+
+def codeHash(functions):
+    return hashlib.sha1("".join(inspect.getsource(f) for f in functions).encode()).hexdigest()
+
+class Result:
+    # A stage's output: its content hash, and the value, loaded on demand
+
+    def __init__(self, hash, value = None, load = None):
+        self.hash = hash
+        self.loaded = load is None
+        self._value = value
+        self.load = load
+
+    def value(self):
+        if not self.loaded:
+            self._value = self.load()
+            self.loaded = True
+        return self._value
+
+class Pipeline:
+
+    def __init__(self, cache = cacheDir):
+        self.cache = cache
+        self.results = {} # key -> Result, this refresh
+        self.timings = [] # [stage, status, seconds, output hash]
+
+    def source(self, name, value):
+        # An input from outside the pipeline
+        result = Result(contentHash(value), value)
+        self.timings.append([name, "input", 0.0, result.hash])
+        return result
+
+    def stage(self, name, fn, *inputs, code = (), valid = None):
+        # Run fn on the values of the input Results, or reuse its output.
+        # code lists further functions whose source is part of the key.
+        # valid(entry), if given, decides whether a cached entry still holds.
+        key = hashlib.sha1(repr((name, codeHash((fn,) + tuple(code)),
+                                 [r.hash for r in inputs])).encode()).hexdigest()
+        if key in self.results: return self.results[key]
+        timing = [name, "cached", 0.0, None]
+        self.timings.append(timing)
+        start = time.perf_counter()
+        entry = self.entry(name, key)
+        if entry is not None and (valid is None or valid(entry)):
+            def load():
+                loadStart = time.perf_counter()
+                with open(self.path(name, key, ".pkl"), 'rb') as f:
+                    value = pickle.load(f)
+                timing[1] = "loaded"
+                timing[2] += time.perf_counter() - loadStart
+                return value
+            result = Result(entry["hash"], load = load)
+        else:
+            values = [r.value() for r in inputs]
+            start = time.perf_counter() # Not counting the inputs' loading
+            with timed("refresh", step = name):
+                value = fn(*values)
+            result = Result(contentHash(value), value)
+            timing[1] = "ran"
+            self.save(name, key, result)
+        timing[2] += time.perf_counter() - start
+        timing[3] = result.hash
+        self.results[key] = result
+        return result
+
+    def path(self, name, key, suffix):
+        return os.path.join(self.cache, "%s-%s%s" % (name, key[:16], suffix))
+
+    def entry(self, name, key):
+        try:
+            with open(self.path(name, key, ".json")) as f:
+                entry = json.load(f)
+            if entry["key"] == key and os.path.exists(self.path(name, key, ".pkl")):
+                return entry
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def save(self, name, key, result):
+        # Pickle a stage's output, then publish it with its entry. Older
+        # outputs of the stage beyond entriesKept are removed.
+        os.makedirs(self.cache, exist_ok = True)
+        with open(self.path(name, key, ".pkl"), 'wb') as f:
+            pickle.dump(result.value(), f, pickle.HIGHEST_PROTOCOL)
+        temp = self.path(name, key, ".json.%d" % os.getpid())
+        with open(temp, 'w') as f:
+            json.dump({"key": key, "hash": result.hash, "time": time.time()}, f)
+        os.replace(temp, self.path(name, key, ".json"))
+
+        entries = sorted((f for f in os.listdir(self.cache)
+                          if f.startswith(name + "-") and f.endswith(".json")),
+                         key = lambda f: os.path.getmtime(os.path.join(self.cache, f)))
+        for old in entries[:-entriesKept]:
+            for suffix in (".json", ".pkl"):
+                try: os.remove(os.path.join(self.cache, old[:-len(".json")] + suffix))
+                except OSError: pass
+
+    def summary(self):
+        lines = ["%-10s %-7s %9s  %s" % ("Stage", "Status", "Seconds", "Output")]
+        for name, status, seconds, hash in self.timings:
+            lines.append("%-10s %-7s %9.3f  %s" % (name, status, seconds, (hash or "")[:12]))
+        lines.append("%-10s %-7s %9.3f" % ("total", "", sum(t[2] for t in self.timings)))
+        return "\n".join(lines)
+
+# Stages, on copies of their inputs, which stay cached in memory
+
+def fetchFeeds(urls):
+    return PullData.getRawData(urls)
+
+def normalizeFeeds(feeds):
+    return PullData.normalizeFeeds([df.copy(deep = True) for df in feeds])
+
+def imputeCounts(histDF):
+    return PullData.markNulls(histDF.copy())
+
+def dailyCounts(imputed):
+    return addDerived(PullData.getDailyDF(imputed.copy())) # Add the Total of all counters
+
+def writeCSV(df, path):
+    # Write a frame as CSV, with the line endings the file had
+    newline = "\n"
+    try:
+        with open(path, 'rb') as f:
+            if f.readline().endswith(b"\r\n"): newline = "\r\n"
+    except OSError:
+        pass
+    with open(path, 'w', newline = '') as f:
+        f.write(df.to_csv().replace("\n", newline))
+
+def refresh(outputs = ("histDF", "predictorsDF"), urls = None, weatherPath = None,
+            write = True, refetch = False, cache = cacheDir, directory = dataDir):
+    # Run the pipeline, writing the given outputs to their CSVs in
+    # directory. Returns the Pipeline, with the stage timings.
+    pipeline = Pipeline(cache)
+    paths = {"histDF": os.path.join(directory, os.path.basename(PullData.histPath)),
+             "predictorsDF": os.path.join(directory, os.path.basename(PullData.predPath))}
+
+    fresh = lambda entry: not refetch and time.time() - entry["time"] < fetchAge
+    feeds = pipeline.stage("fetch", fetchFeeds, pipeline.source("urls", urls or PullData.urlDict),
+                           code = [PullData.getRawData, PullData.getJSON], valid = fresh)
+    totals = pipeline.stage("normalize", normalizeFeeds, feeds,
+                            code = [PullData.normalizeFeeds, PullData.counterTotals])
+    frames = {"histDF": pipeline.stage("merge", PullData.mergeCounters, totals)}
+    if "predictorsDF" in outputs:
+        imputed = pipeline.stage("impute", imputeCounts, frames["histDF"],
+                                 code = [PullData.markNulls, PullData.imputationRatios])
+        daily = pipeline.stage("daily", dailyCounts, imputed, code = [PullData.getDailyDF])
+        weather = pipeline.source("weatherDF", PullData.readWeather(weatherPath or
+                                                                    PullData.weatherPath))
+        frames["predictorsDF"] = pipeline.stage("weather", PullData.joinWeather, daily, weather)
+
+    if write:
+        targets = [paths[name] for name in outputs]
+        def writeAll(targets, *dfs):
+            for df, path in zip(dfs, targets): writeCSV(df, path)
+            return [sourceStamp(path) for path in targets]
+        def unchanged(entry):
+            # Skip the write while the files are as it left them
+            try:
+                return entry["hash"] == contentHash([sourceStamp(path) for path in targets])
+            except OSError:
+                return False
+        pipeline.stage("write", writeAll, pipeline.source("targets", targets),
+                       *[frames[name] for name in outputs], valid = unchanged)
+
+    log.info("Refresh stages:\n%s", pipeline.summary())
+    return pipeline
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Refresh histDF.csv and predictorsDF.csv")
+    parser.add_argument("--refetch", action = "store_true",
+                        help = "download the feeds even if downloaded within the hour")
+    parser.add_argument("--no-write", dest = "write", action = "store_false",
+                        help = "compute everything, but leave the CSVs as they are")
+    parser.add_argument("--clear", action = "store_true", help = "empty the stage cache first")
+    parser.add_argument("--cache", default = cacheDir, help = "directory of the stage cache")
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO)
+
+    if args.clear and os.path.isdir(args.cache):
+        for f in os.listdir(args.cache): os.remove(os.path.join(args.cache, f))
+    pipeline = refresh(write = args.write, refetch = args.refetch, cache = args.cache)
+    print(pipeline.summary())
@@ -0,0 +1,169 @@
+import argparse
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+from Counters import measured, feedView, layouts
+
+# A local stand-in for the parts of the Seattle Data Portal the data refresh
+# uses, serving counter feeds rebuilt from histDF:
+#
+#   /api/views/<view>/rows.json  a whole feed (PullData.getRawData)
+#   /api/views/<view>.json       the columns of a feed
+#   /resource/<view>.json        a feed's rows as records, after a time, with
+#                                $where=<field> > '<time>', $limit and $offset
+#                                (IncrementalUpdate)
+#
+# The refresh is pointed at it with BIKE_PORTAL, or given its URLs:
+#
+#     python PortalStandIn.py --port 8001
+#     BIKE_PORTAL=http://localhost:8001 python -c "import PullData; PullData.updateAll(True)"
+
+def feedFixtures(histDF):
+    # Raw counter feeds, the date and counts of the portal's rows as strings,
+    # rebuilt from histDF, in measured() order.
+    # Bikes are split evenly between directions, and pedestrians are zero.
+    dates = np.asarray(histDF.index.strftime('%Y-%m-%dT%H:%M:%S'), dtype = object)
+    feeds = []
+    for c in measured():
+        counts = histDF[c.column].values.astype(float)
+        first = int(np.argmax(~np.isnan(counts))) # The counter's first reading
+        bikes = counts[first:]
+        north = np.floor(bikes / 2)
+        south = bikes - north
+        none = np.where(np.isnan(bikes), np.nan, 0.0)
+        columns = {"bike": [bikes, north, south],
+                   "bikeped": [bikes, none, none, north, south],
+                   "fremont": [north, south]}[c.layout]
+        df = pd.DataFrame({0: dates[first:]})
+        for j, values in enumerate(columns, 1):
+            text = values.astype(str).astype(object)
+            text[np.isnan(values)] = None
+            df[j] = text
+        feeds.append(df)
+    return feeds
+
+def rowsJSON(feed):
+    # A feed in the portal's rows.json format, whose rows start with eight
+    # metadata fields
+    rows = [["row-%d" % i, "00000000-0000-0000-0000-%012d" % i, 0, 1512086400, None,
+             1512086400, None, "{ }"] + list(values)
+            for i, values in enumerate(feed.itertuples(index = False))]
+    return json.dumps({"meta": {"view": {}}, "data": rows}).encode()
+
+class Portal:
+    # Responses for the feeds of the measured counters
+
+    def __init__(self, feeds, delay = 0):
+        self.delay = delay # Seconds before each response, as latency
+        self.feeds = {}
+        for c, feed in zip(measured(), feeds):
+            fields = ["date"] + [name.lower() for name in layouts[c.layout]]
+            self.feeds[feedView(c)] = (fields, feed)
+        self.bodies = {} # rows.json by view, made on first request
+        self.requests = [] # Paths requested, for tests
+
+    def rows(self, view):
+        if view not in self.bodies: self.bodies[view] = rowsJSON(self.feeds[view][1])
+        return self.bodies[view]
+
+    def columns(self, view):
+        fields = self.feeds[view][0]
+        return json.dumps({"id": view, "columns": [
+            {"fieldName": name, "position": i + 1,
+             "dataTypeName": "floating_timestamp" if i == 0 else "text"}
+            for i, name in enumerate(fields)] + [
+            {"fieldName": ":id", "position": 0, "dataTypeName": "meta_data"}]}).encode()
+
+    def records(self, view, query):
+        fields, feed = self.feeds[view]
+        dates = feed.iloc[:, 0].values.astype('datetime64[s]')
+        first = 0
+        where = query.get("$where", [None])[0]
+        if where:
+            match = re.match(r"\s*(\w+)\s*>\s*'([^']*)'\s*$", where)
+            if not match or match.group(1) != fields[0]:
+                raise ValueError("Unsupported $where: " + where)
+            first = int(np.searchsorted(dates, np.datetime64(match.group(2), 's'),
+                                        side = 'right'))
+        first += int(query.get("$offset", [0])[0])
+        last = first + int(query.get("$limit", [1000])[0])
+        records = []
+        for values in feed.iloc[first:last].itertuples(index = False):
+            record = {"date": values[0] + ".000"}
+            for name, value in zip(fields[1:], values[1:]):
+                if value is not None: record[name] = value # Nulls are left out
+            records.append(record)
+        return json.dumps(records).encode()
+
+    def respond(self, path):
+        # Body of the response to a request path, or None for a 404
+        self.requests.append(path)
+        url = urlparse(path)
+        match = re.match(r"/api/views/([^/.]+)(/rows)?\.json$", url.path)
+        if match and match.group(1) in self.feeds:
+            if match.group(2): return self.rows(match.group(1))
+            return self.columns(match.group(1))
+        match = re.match(r"/resource/([^/.]+)\.json$", url.path)
+        if match and match.group(1) in self.feeds:
+            return self.records(match.group(1), parse_qs(url.query))
+        return None
+
+    def feedURLs(self, base):
+        # URLs of the whole feeds by counter column, for PullData.getRawData
+        return {c.column: "%s/api/views/%s/rows.json" % (base, feedView(c)) for c in measured()}
+
+class PortalServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class PortalHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        try:
+            body = self.server.portal.respond(self.path)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        if body is None:
+            self.send_error(404)
+            return
+        time.sleep(self.server.portal.delay)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@contextmanager
+def serve(portal, port = 0):
+    # Serve a Portal from a local thread; yields its base URL
+    server = PortalServer(("127.0.0.1", port), PortalHandler)
+    server.portal = portal
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    try:
+        yield "http://127.0.0.1:%d" % server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+if __name__ == "__main__":
+    from SharedData import getHistDF
+    parser = argparse.ArgumentParser(description = "Serve the counter feeds from histDF")
+    parser.add_argument("--port", type = int, default = 8001)
+    parser.add_argument("--delay", type = float, default = 0, help = "latency in seconds")
+    args = parser.parse_args()
+    with serve(Portal(feedFixtures(getHistDF()), args.delay), args.port) as base:
+        print("Serving the portal at " + base)
+        try:
+            while True: time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
@@ -1,128 +1,94 @@
+import hashlib
+import pickle
 import pandas as pd
 import numpy as np
-from datetime import datetime, timedelta
-from fbprophet import Prophet
+from datetime import timedelta
 import matplotlib.pyplot as plt
 import seaborn as sns
 from bokeh.plotting import figure, output_file #show
-from bokeh.models import FuncTickFormatter, ColumnDataSource, DataRange1d, Plot,Range1d, LinearAxis, Grid
+from bokeh.models import FuncTickFormatter, ColumnDataSource, DataRange1d, Plot,Range1d, LinearAxis, Grid, FixedTicker
 from bokeh.layouts import widgetbox, layout
 from bokeh.io import curdoc
-from bokeh.models.widgets import Select
+from bokeh.models.widgets import Select, Div, RadioButtonGroup
 #from bokeh.models.glyphs import VBar, Line
-import os
 
-import pickle
+from ResultCache import resultCache, dataToken
+from SharedData import shared, getPredictorsDF, getHistDF, getWeatherDF
+from CallbackScheduler import DebouncedCallback
+from SourceUpdate import SourceUpdater
+from FastForecast import ForecastEngine, dayNumbers
+from ForecastModes import predictForecast
+from ForecastService import ForecastService, localNow, describeAge
+from ModelTraining import trainModels, writeModel, formatReport
+from ModelArtifacts import ModelStore, loadPickle, modelCount
+from Counters import counters, firstRow
+from HourlyProfiles import buildProfiles, hourlyForecast
+from WeatherProvider import defaultProvider
+from Metrics import timed, trackSession, start as startMetrics
+
+
+# Daily counts and weather, indexed by date objects (eg 2012-10-03), with a
+# log(precipitation) column. Shared by all sessions; do not modify.
+predictorsDF = getPredictorsDF()
+WeekdayNames = ['Monday', 'Tuesday', 'Weds', 'Thursday', 'Friday', 'Saturday', 'Sunday']
 
+# Counter names and their column numbers in predictorsDF, which are also the
+# numbers of their models, from the counter registry
+counterDict = {c.label: predictorsDF.columns.get_loc(c.column) for c in counters}
+counterNames = sorted(counterDict, key = counterDict.get)
 
-#predPath = r"C:\Users\asher\Documents\GitHub\data602-finalproject\predictorsDF.csv"
-predPath = "https://raw.githubusercontent.com/cspitmit03/data602-finalproject/master/predictorsDF.csv"
-predictorsDF = pd.read_csv(predPath, index_col = 0)
-predictorsDF["logPrecip"] = np.log(predictorsDF["Precip"]+1) # Add a log(precipitation) column
-WeekdayNames = ['Monday', 'Tuesday', 'Weds', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-counterNames = ["Burke Gilman Trail", "Broad", "Elliott", "Fremont Bridge",
-                "MTS Trail", "NW 58th St", "2nd Ave", "Spokane St", 
-                "39th Ave", "26th Ave", "Total"]
-
-# Dictionary for converting full trail names to column numbers
-counterDict = {"Burke Gilman Trail":0,
-               "Broad": 1,
-               "Elliott": 2,
-               "Fremont Bridge": 3,
-               "MTS Trail": 4,
-               "NW 58th St": 5,
-               "2nd Ave": 6,
-               "Spokane St": 7,
-               "39th Ave": 8,
-               "26th Ave": 9,
-               "Total": 10}
-
-
-Indx = [] # Index to hold dates
-for i in range(len(predictorsDF)): 
-    # Convert strings containing dates (eg '2012-10-03') to date objects
-    Indx.append(datetime.strptime(predictorsDF.index[i], '%Y-%m-%d').date())
-predictorsDF.index = Indx
-
-
-
-def CreateModels():
-# Create a list of Prophet forecasts, one series for each counter
-    Models = []
-    
-    for i in range(11):
-        # Start dataframe at each counter with first date counter was active.
-        # All counters except Fremont and Second began on 1/1/2014
-        if predictorsDF.columns[i] == 'Fremont': k = 0 # 10/3/2012
-        elif (predictorsDF.columns[i] == 'Second') | (predictorsDF.columns[i] == 'Total') : 
-            k = 820 # 1/1/2015
-        else: k = 455    #1/1/2014
-        
-        df = pd.DataFrame(data = {'ds': predictorsDF.index[k:], # dates
-                              'y': predictorsDF.iloc[k:, i], # Counts
-                              'logPrecip': predictorsDF['logPrecip'][k:], # log of rainfall in inches
-                                 'TempHi': predictorsDF['TempHi'][k:],  # Daily high temperature, Fahrenheit
-                                 'cap': max(predictorsDF.iloc[k:, i]),
-                                 'floor': min(predictorsDF.iloc[k:, i])}) # Maximum value = maximum observed in dataset
-    
-        # Create the Prophet Model
-        m = Prophet(growth='linear', yearly_seasonality=True, daily_seasonality = False, 
-                    weekly_seasonality = True)
-        m.add_regressor('logPrecip')
-        m.add_regressor('TempHi')
+
+
+def CreateModels(processes = None):
+# Create a list of Prophet forecasts, one series for each counter, fitted in
+# parallel. A model that fails to fit is None, and reported.
+    models, report = trainModels(predictorsDF, processes = processes)
+    print(formatReport(report))
     
-        # Fit the Prpohet Model
-        m.fit(df)
-        Models.append(m)
-        
-    return Models
+    return [models[i] for i in range(modelCount)]
 
-def CreatePickleModels():
-    Models = CreateModels()
-    for i in range(11):
-        filename = 'Models' + str(i) + '.pkl'
-        with open(filename, 'wb') as output:
-            pickle.dump(Models[i], output, pickle.HIGHEST_PROTOCOL)
+def CreatePickleModels(processes = None, incremental = False):
+    # Fit the models in parallel, writing each one as soon as it is fitted.
+    # Incremental retraining skips the counters whose data is unchanged, and
+    # warm starts the others from their stored models.
+    models, report = trainModels(predictorsDF, processes = processes,
+                                 onModel = writeModel, incremental = incremental)
+    print(formatReport(report))
     return 
 
 def LoadPickleModels():
-    dir_path = os.path.dirname(os.path.realpath('Predict.py'))
-    os.chdir(dir_path)
-    
+    # Models are stored next to this script, whatever the working directory.
+    # Loads every full Prophet model; the app uses a lazy ModelStore instead.
     Models = []
-    for i in range(11): 
-        filename = 'Models' + str(i) + '.pkl'
-        with open(filename, 'rb') as input:
-            Models.append(pickle.load(input))
+    for i in range(modelCount): 
+        Models.append(loadPickle(i))
             
     return Models
 
-def GetWeather(days = 7):
-    # Get weather forecast data, to predict upcoming bike counts using weatherbit API, in Imperial measures.
-    ForecastURL= 'http://api.wunderground.com/api/91468d8e9a46ecc5/forecast10day/q/WA/Seattle.json'
-    forecastJSON = pd.read_json(ForecastURL) # Read in the JSON data from API call
-    logPrecip = [] # list to house rainfall forecasts
-    TempHi = []
-    for i in range(days): 
-        DayDict = forecastJSON.iloc[1, 0]['forecastday'][i] # Identify location in JSON where data appears
-        logPrecip.append(np.log(DayDict['qpf_allday']['in'] + 1)) # Add 1 to avoid log of zero
-        TempHi.append(int(DayDict['high']['fahrenheit'])) 
-        
+def GetWeather(dates):
+    # Get the weather forecast of the dates, to predict upcoming bike counts, in Imperial measures.
+    # Served by the shared WeatherProvider, which answers within seconds even if the weather API is down.
+    forecast = Weather.forecastFor(dates)
+    logPrecip = list(np.log(forecast['Precip'].values + 1)) # Add 1 to avoid log of zero
+    TempHi = list(forecast['TempHi'].values)
+
     return logPrecip, TempHi
 
 # Create the dataframe to house the dates to predict, and their forecasted weather
 
 # Get a table of forecasts for the next X days, where x is an integer between 1
-# and 10 inclusive
-def GetForecastTable(Models, days = 7):
+# and 10 inclusive. mode is one of ForecastModes.forecastModes: "point" and
+# "analytic" evaluate every model at once, "sampled" runs each model's 
+# predict() with the given number of uncertainty samples.
+def GetForecastTable(Models, days = 7, engine = None, mode = "point", samples = 1000):
 
-    thisDay = datetime.utcnow() - timedelta(hours=8) # subtract UTC time
+    thisDay = localNow() # Seattle time
     date_list = [(thisDay + timedelta(days=x)).date() for x in range(0, days)]
     
     # Compute number of days since last date of actuals, in this case October 31, 2017
     #delt = (datetime.today().date() - datetime(2017, 10, 31).date()).days
     
-    logPrecip, TempHi = GetWeather()
+    logPrecip, TempHi = GetWeather(date_list)
         
     # Create dataframe
     future = pd.DataFrame({'TempHi': TempHi,
@@ -133,12 +99,24 @@ def GetForecastTable(Models, days = 7):
                          index = list(range(days)))
     
     # Create table of forecasts
-    # Forecasts contains the point estimate forecast, as well as the confidence 
-    # interval, trend components, and other statistical information about the model
+    # Forecasts contains the point estimate forecast and its trend component,
+    # for each model, with their intervals unless mode is "point"
     Forecasts = []
     ForecastTable = pd.DataFrame({}, index = date_list)
-    for i in range(11):
-        Forecasts.append(Models[i].predict(future))
+    if mode == "sampled":
+        with timed("predict", mode = mode, scope = "forecast"):
+            for i in range(len(Models)):
+                Forecasts.append(predictForecast(Models[i], future, mode, samples))
+    else: # Evaluate every model at once
+        engine = engine or ForecastEngine(Models)
+        with timed("predict", mode = mode, scope = "forecast"):
+            prediction = engine.predict(future['ds'], future, 
+                                        intervals = mode == "analytic")
+        for i in range(engine.size):
+            Forecasts.append(pd.DataFrame({'ds': pd.to_datetime(date_list)}))
+            for name, values in prediction.items():
+                Forecasts[i][name] = values[:, i]
+    for i in range(len(Forecasts)):
         ForecastTable[predictorsDF.columns[i]] = Forecasts[i]['yhat'].values# Create column for each counter forecast
     
     ForecastTable = round(ForecastTable)
@@ -148,41 +126,68 @@ def GetForecastTable(Models, days = 7):
     ForecastTable[ForecastTable < 0 ] = 0
     return ForecastTable, Forecasts, future
 
-def PlotTrendAnalysis(Models, counterNumber = 10):
-    # Plots the historical trends as detected by the model
-    
-    if counterNumber == 3: k = 0 # Fremont, started 10/3/2012
-    elif (counterNumber == 6) | (counterNumber == 10): k = 820 # Second St, started 1/1/2015
-    else: k = 455    # All others, started 1/1/2014
-    
-    future = pd.DataFrame({'TempHi': predictorsDF["TempHi"][k:],
-                      'logPrecip': predictorsDF["logPrecip"][k:],
-                      'ds': predictorsDF.index[k:],
-                      'floor': 0,
-                      'cap': max(predictorsDF.iloc[k:, counterNumber][k:])},
-                     index = predictorsDF.index[k:])
-    
-    forecast = Models[counterNumber].predict(future)
-    Models[counterNumber].plot_components(forecast)
+def GetHourlyForecast(ForecastTable, WeatherTable, profiles):
+    # Expected counts for every hour of the forecast days, shaped 
+    # (days, counters, 24), splitting each day's forecast by the counter's 
+    # hourly profile for the weekday, season and forecast rainfall (see 
+    # HourlyProfiles)
+    precip = np.exp(WeatherTable.logPrecip.values) - 1
+    return hourlyForecast(profiles, ForecastTable.index, ForecastTable.values, precip)
+
+def HistoryFrame(counterNumber):
+    # Dates and weather of a counter's history, for predicting in-sample
+    k = firstRow(predictorsDF.index, predictorsDF.columns[counterNumber])
+    
+    return pd.DataFrame({'TempHi': predictorsDF["TempHi"][k:],
+                         'logPrecip': predictorsDF["logPrecip"][k:],
+                         'ds': predictorsDF.index[k:],
+                         'floor': 0,
+                         'cap': max(predictorsDF.iloc[k:, counterNumber])},
+                        index = predictorsDF.index[k:])
+
+def ModelVersion(Models, counterNumber):
+    # Identifies the fit of a model by the hash of its pickle: the stored one
+    # for a ModelStore, or pickled here for a list of fitted models (an
+    # object's id can be reused by a later fit)
+    if hasattr(Models, 'version'): return Models.version(counterNumber)
+    return hashlib.sha1(pickle.dumps(Models[counterNumber], pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+def Decomposition(Models, counterNumber, mode = "point", samples = 1000):
+    # In-sample forecast of a counter, with its trend and seasonal components.
+    # Cached per model version and forecast mode, and shared by the plots.
+    key = (ModelVersion(Models, counterNumber), counterNumber, mode, samples)
+    cached = resultCache.get("Decomposition", key)
+    if cached is None:
+        with timed("predict", mode = mode, scope = "history"):
+            forecast = predictForecast(Models[counterNumber], HistoryFrame(counterNumber),
+                                       mode, samples)
+        cached = {"forecast": forecast}
+        resultCache.put("Decomposition", key, cached)
+    return cached["forecast"]
+
+def GrowthRates(Models, engine = None, lastDate = None):
+    # Trailing annual growth rate of every counter's trend, in percent: the
+    # trend on lastDate (by default the last date of history) against 364 
+    # days earlier. Computed from the models' trend parameters.
+    engine = engine or ForecastEngine(Models)
+    lastDate = pd.Timestamp(lastDate or predictorsDF.index[-1])
+    days = dayNumbers([lastDate - timedelta(days = 364), lastDate])
+    _, trend = engine.trend(days)
+    rates = np.where(engine.valid, 100*(trend[1]/trend[0] - 1), np.nan)
+    return pd.Series(np.trunc(rates*10)/10, index = counterNames[:engine.size])
+
+def PlotTrendAnalysis(Models, counterNumber = 10, mode = "point", samples = 1000):
+    # Plots the historical trends as detected by the model, with intervals
+    # unless mode is "point"
+    forecast = Decomposition(Models, counterNumber, mode, samples)
+    Models[counterNumber].plot_components(forecast, uncertainty = mode != "point")
     
     return
 
-def PlotHistoricalModel(Models, counterNumber = 10):
-    # Plots the model against past data
-    
-    if counterNumber == 3: k = 0 # Fremont, started 10/3/2012
-    elif (counterNumber == 6) | (counterNumber == 10): k = 820 # Second St, started 1/1/2015
-    else: k = 455    # All others, started 1/1/2014
-    
-    future = pd.DataFrame({'TempHi': predictorsDF["TempHi"][k:],
-                      'logPrecip': predictorsDF["logPrecip"][k:],
-                      'ds': predictorsDF.index[k:],
-                      'floor': 0,
-                      'cap': max(predictorsDF.iloc[k:, counterNumber][k:])},
-                     index = predictorsDF.index[k:])
-    
-    forecast = Models[counterNumber].predict(future)
-    Models[counterNumber].plot(forecast)
+def PlotHistoricalModel(Models, counterNumber = 10, mode = "point", samples = 1000):
+    # Plots the model against past data, with intervals unless mode is "point"
+    forecast = Decomposition(Models, counterNumber, mode, samples)
+    Models[counterNumber].plot(forecast, uncertainty = mode != "point")
     
     return
 
@@ -203,23 +208,12 @@ def PlotCounterForecast(CounterNumber, ForecastTable):
 
     plt.show()
     
-def PlotSecularTrend(Models, counterNumber):
-    if counterNumber == 3: k = 0 # Fremont, started 10/3/2012
-    elif (counterNumber == 6) | (counterNumber == 10): k = 820 # Second St, started 1/1/2015
-    else: k = 455    # All others, started 1/1/2014
-    
-    future = pd.DataFrame({'TempHi': predictorsDF["TempHi"][k:],
-                      'logPrecip': predictorsDF["logPrecip"][k:],
-                      'ds': predictorsDF.index[k:],
-                      'floor': 0,
-                      'cap': max(predictorsDF.iloc[k:, counterNumber][k:])},
-                     index = predictorsDF.index[k:])
-    
-    forecast = Models[counterNumber].predict(future)
+def PlotSecularTrend(Models, counterNumber, mode = "point", samples = 1000, engine = None):
+    # Plots the trend, which needs no intervals
+    forecast = Decomposition(Models, counterNumber, mode, samples)
     
-    # Calculate Rate of Change for the last 365 days
-    GrowthRate = 1000*(forecast.trend[-1:].values/forecast.trend[-365:-364].values) - 1000
-    GrowthRate = int(GrowthRate)/10
+    # Rate of Change for the last 365 days, from the trend parameters
+    GrowthRate = GrowthRates(Models, engine).iloc[counterNumber]
     
     
     sns.set_style("darkgrid")
@@ -258,18 +252,45 @@ def plotForecast(ForecastTable, counterNumber):
     
     return p
 
+# Stage timings and session counts, served when metrics are enabled
+startMetrics()
+trackSession(curdoc(), "Predict")
+
+# Models and forecasts are loaded once per server process, by the first
+# session, and shared by the sessions after it. The forecast only needs the
+# models' compact artifacts; full Prophet models (Models[i]) are unpickled
+# on first use.
 #Models = CreateModels()
-Models = LoadPickleModels()
-ForecastTable, Forecasts, WeatherTable = GetForecastTable(Models, days = 7)
-logPrecip, TempHi = GetWeather()
-Precip = list(np.exp(logPrecip)-1)
-#WeatherTable['Precip'] = np.exp(WeatherTable.logPrecip) - 1
+Models = shared("Models", ModelStore)
+Engine = shared("ForecastEngine", lambda: ForecastEngine(Models.allParams()))
+Weather = shared("WeatherProvider", lambda: defaultProvider(getWeatherDF()))
+
+# The forecast is refreshed hourly and after midnight by a background thread;
+# each session uses the latest one when it opens
+Service = shared("ForecastService", 
+                 lambda: ForecastService(lambda: GetForecastTable(Models, days = 7,
+                                                                  engine = Engine)))
+ForecastTable, Forecasts, WeatherTable = Service.get()
+forecastVersion, forecastUpdated = Service.version, Service.updated
+Precip = list(np.exp(WeatherTable.logPrecip)-1)
+
+# Hour-of-week profiles of every counter, from the hourly history, to split
+# the daily forecasts into hours
+Profiles = shared("hourlyProfiles", lambda: buildProfiles(getHistDF(), getWeatherDF()))
+HourlyTable = GetHourlyForecast(ForecastTable, WeatherTable, Profiles)
+
+# Results cached by other sessions stay valid until the data changes, and are
+# keyed by forecast version
+cacheName = "Predict"
+resultCache.validate(cacheName, dataToken(predictorsDF))
+resultCache.validate("Decomposition", dataToken(predictorsDF))
 
 # Set up data
 x =  [0,1,2,3,4,5,6]
 top = ForecastTable.iloc[:, 3]
 y = Precip
 source = ColumnDataSource(data=dict(x=x, top=top, y=y))
+sourceUpdate = SourceUpdater(source) # Sends only the changed columns
 
 def plotBokeh(ymax = 800):
     
@@ -286,7 +307,7 @@ def plotBokeh(ymax = 800):
     #             fill_color="DeepSkyBlue")
     
     p.vbar(x ="x", width = 0.4, bottom = 0, top ="top", source=source,
-           color = "Navy", legend = "Bike Count")
+           color = "Navy", legend = "Bike Count", name = "counts")
     
     #p.add_glyph(source, glyph)
 
@@ -305,6 +326,7 @@ def plotBokeh(ymax = 800):
     for i, s in enumerate(dayNames):
         label_dict[i] = s
 
+    p.xaxis.ticker = FixedTicker(ticks = list(range(7)))
     p.xaxis.formatter = FuncTickFormatter(code="""
         var labels = %s;
         return labels[tick];
@@ -313,6 +335,7 @@ def plotBokeh(ymax = 800):
     return p
 
 plot = plotBokeh()
+bars = plot.select_one({"name": "counts"})
 
 # Widgets section
 
@@ -321,23 +344,58 @@ plot = plotBokeh()
 CounterDropdown = Select(title = "Select Counter", value = "Fremont Bridge", 
                              options = counterNames)
 
-# Set up callbacks
-def update_data(attrname, old, new):
+# Daily totals, or expected counts for each hour of the week
+ModeButtons = RadioButtonGroup(labels = ["Daily", "Hourly"], active = 0)
 
+# Set up callbacks
+def readState():
     # Get the current slider values
-    counter = counterDict[CounterDropdown.value]
-    x =  [0,1,2,3,4,5,6] 
-    
-    top = ForecastTable.iloc[:, counter].astype(float)
-    y = Precip
-   
-    source.data = dict(x=x, top=top, y=y)
+    return counterDict[CounterDropdown.value], ModeButtons.active == 1
+
+def computeState(state):
+    # Serve repeated counter selections from the process-wide cache
+    counter, hourly = state
+    key = (forecastVersion, counter, hourly)
+    result = resultCache.get(cacheName, key)
+    if result is None:
+        if hourly: # 24 bars per day, filling the day's slot; rainfall at noon
+            hours = HourlyTable.shape[0]*24
+            x = (np.arange(hours) + 0.5)/24 - 0.5
+            top = HourlyTable[:, counter, :].ravel()
+            y = np.full(hours, np.nan)
+            y[12::24] = Precip
+        else:
+            x =  np.array([0,1,2,3,4,5,6])
+            top = ForecastTable.iloc[:, counter].astype(float).values
+            y = np.array(Precip)
+        result = dict(x=x, top=top, y=y)
+        resultCache.put(cacheName, key, result)
+    return result
+
+def showResult(result):
+    # Only the counts change between counters; x and the rainfall are skipped
+    daily = len(result["x"]) == len(ForecastTable)
+    bars.glyph.width = 0.4 if daily else 0.8/24
+    with timed("source_update", view = "daily" if daily else "hourly"):
+        sourceUpdate.update(result)
+
+# Widget callback, computed off the server's IO loop
+update_data = DebouncedCallback(curdoc(), readState, computeState, showResult)
     
 for w in [CounterDropdown]:
     w.on_change('value', update_data)
+ModeButtons.on_change('active', update_data)
+
+# Age of the forecast shown, kept current while the page is open
+AgeText = Div(text = describeAge(Service, forecastUpdated))
+
+def update_age():
+    AgeText.text = describeAge(Service, forecastUpdated)
+
+curdoc().add_periodic_callback(update_age, 60000)
 
 # Set up layouts and add to document
-inputs = widgetbox(CounterDropdown)
+inputs = widgetbox(CounterDropdown, ModeButtons, AgeText)
 
 
 lay = layout([
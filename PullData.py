@@ -1,25 +1,37 @@
-import urllib.request, json 
+import urllib.request
+from urllib.error import HTTPError
+import logging, os, time
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from datetime import datetime, timedelta
 import numpy as np
 import matplotlib.pyplot as plt
+from Counters import measured, columns, byColumn, feedLayout, referenceCounter
+from FeedParser import readRows, feedFrame
+from Snapshot import dataDir, datasets
 # from pd.io.json import json_normalize
 
-# Dictionary of Counters and their JSON file location
-urlDict = {"BGT": "https://data.seattle.gov/api/views/2z5v-ecg8/rows.json?accessType=DOWNLOAD",
-           "Broad": "https://data.seattle.gov/api/views/j4vh-b42a/rows.json?accessType=DOWNLOAD",
-           "Elliot": "https://data.seattle.gov/api/views/4qej-qvrz/rows.json?accessType=DOWNLOAD",
-           "Fremont": "https://data.seattle.gov/api/views/65db-xm6k/rows.json?accessType=DOWNLOAD",
-           "MTS": "https://data.seattle.gov/api/views/u38e-ybnc/rows.json?accessType=DOWNLOAD",
-           "NW58": "https://data.seattle.gov/api/views/47yq-6ugv/rows.json?accessType=DOWNLOAD",   
-           "Second": "https://data.seattle.gov/api/views/avwm-i8ym/rows.json?accessType=DOWNLOAD",
-           "Spokane": "https://data.seattle.gov/api/views/upms-nr8w/rows.json?accessType=DOWNLOAD",
-           "Thirty": "https://data.seattle.gov/api/views/3h7e-f49s/rows.json?accessType=DOWNLOAD",
-           "TwoSix": "https://data.seattle.gov/api/views/mefu-7eau/rows.json?accessType=DOWNLOAD"
-           }
-# Create an alphabetical list of counters
-Counters = list(urlDict.keys())
-Counters.sort()
+log = logging.getLogger(__name__)
+
+# Counters with a feed, in column order, and their JSON file location (see
+# Counters.py). BIKE_FEED_URL replaces the portal, e.g. with a local server
+# of test files: "http://localhost:8000/{column}.json".
+Counters = columns(measured())
+urlDict = {c.column: c.url for c in measured()}
+if os.environ.get("BIKE_FEED_URL"):
+    urlDict = {c: os.environ["BIKE_FEED_URL"].format(column = c) for c in Counters}
+
+# Datasets written by the refresh (see Snapshot.py)
+histPath = os.path.join(dataDir, datasets["histDF"]["csv"])
+predPath = os.path.join(dataDir, datasets["predictorsDF"]["csv"])
+weatherPath = os.path.join(dataDir, datasets["weatherDF"]["csv"])
+
+# Feeds are downloaded `feedWorkers` at a time. A failed download is retried
+# `feedRetries` times, after retryDelay seconds, then twice that, and so on.
+feedWorkers = 4
+feedTimeout = 120 # Seconds without data before a download fails
+feedRetries = 3
+retryDelay = 2
 
 # Column list for later use in reordering columns for ped & bike counters
 PBColOrder = ["Date","BTotal", "PBTotal", "PedNB", "PedSB", "BikeNB", "BikeSB"]
@@ -28,59 +40,97 @@ plt.style.use('fivethirtyeight')
 
 # Get JSON files of a single counter; 
 # "counter" is the name of a counter, a string, like "BGT"
-def getJSON(counter):
-    with urllib.request.urlopen(urlDict[counter]) as url:
-        data = json.loads(url.read().decode())
-        df = pd.io.json.json_normalize(data, record_path = "data").iloc[:,8:]
+def getJSON(counter, url = None):
+    # Parsed as it downloads, keeping only the dates and counts (see FeedParser)
+    start = time.perf_counter()
+    with urllib.request.urlopen(url or urlDict[counter], timeout = feedTimeout) as response:
+        length = getattr(response, "headers", {}).get("Content-Length")
+        dates, counts, size = readRows(response, int(length) if length else None)
+    df = feedFrame(dates, counts)
+    log.info("Feed of %s: %.1f MB, %d rows in %.1f s", counter, size / 1e6,
+             len(df), time.perf_counter() - start)
     return df
 
-# Download data for each counter, name columns and reorder
-def getRawData():
-    dfList = []
-    for i in range(len(Counters)):
-        dfList.append(getJSON(Counters[i]))
+def retried(fetch, counter):
+    # fetch(), retried with growing delays, except on client errors such as
+    # a wrong URL
+    for attempt in range(feedRetries + 1):
+        try:
+            return fetch()
+        except (OSError, ValueError) as e: # Network errors, timeouts, bad JSON
+            if attempt == feedRetries: raise
+            if isinstance(e, HTTPError) and e.code < 500 and e.code not in (408, 429): raise
+            delay = retryDelay * 2**attempt
+            log.warning("Feed of %s failed (%s: %s), retrying in %g s", counter,
+                        type(e).__name__, e, delay)
+            time.sleep(delay)
+
+def fetchFeed(counter, url = None):
+    return retried(lambda: getJSON(counter, url), counter)
+
+# Download data for each counter, in Counters order. urls, by counter,
+# replaces urlDict, e.g. to read test files.
+def getRawData(urls = None, workers = feedWorkers):
+    urls = urls or urlDict
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        futures = [pool.submit(fetchFeed, counter, urls[counter]) for counter in Counters]
+        try:
+            dfList = [future.result() for future in futures]
+        except Exception:
+            for future in futures: future.cancel() # Those not started yet
+            raise
+    log.info("Downloaded %d feeds in %.1f s", len(dfList), time.perf_counter() - start)
     return dfList
 
-def modifyData(dfList):
-    
+def counterTotals(df, counter):
+    # A counter's bike totals, indexed by date, from its feed frame. Names
+    # and indexes df in place.
+    
+    # Convert counts from strings to numerics
+    for col in df.columns[1:]:
+        df[col] = pd.to_numeric(df[col])
+    
+    # Name columns after the counter's feed layout: bike-only, ped & 
+    # bike, or Fremont Bridge, which lacks a total column. The counter's
+    # column is its bike total.
+    names = feedLayout(byColumn(counter), len(df.columns) - 1)
+    df.columns = ["Date"] + names
+    if "Total" in names: # Bike only counters
+        df[counter] = df["Total"]
+    else:
+        df[counter] = df["BikeNB"] + df["BikeSB"]
+         
+    # Convert date strings to timestamp objects
+    df.index = pd.to_datetime(df["Date"], format = '%Y-%m-%dT%H:%M:%S')
+    return df[[counter]]
+
+def normalizeFeeds(dfList):
+    # Bike totals of each counter, from the feed frames, which are modified
     newList = []
     for i in range(len(Counters)):
-        df = dfList[i]
         # Remove entries with null values (these were defective observations)
         #dfList[i] = dfList[i][pd.notnull(dfList[i].iloc[:, 1])]
-        
-        # Convert counts from strings to numerics
-        for col in df.columns[1:]:
-            df[col] = pd.to_numeric(df[col])
-        
-        # Rename columns, according to whether they are bike-only or ped & bike
-        # counters; Fremont Bridge (i = 3) lacked a total column, so is treated 
-        # separately here
+        newList.append(counterTotals(dfList[i], Counters[i]))
+    return newList
 
-        if len(df.columns) == 4: # For bike only counters
-            df.columns = ["Date", Counters[i], "BikeNB", "BikeSB"]
-        elif len(df.columns) == 6: # For bike and ped counters
-            df.columns = ["Date", "PBTotal", "PedNB", "PedSB", "BikeNB", "BikeSB"]
-            df[Counters[i]] = df["BikeNB"] + df["BikeSB"]
-        else: #Fremont has no total column
-            df.columns = ["Date", "BikeNB", "BikeSB"]
-            df[Counters[i]] = df["BikeNB"] + df["BikeSB"]
-             
-        # Convert date strings to timestamp objects
-        df.index = pd.to_datetime(df["Date"], format = '%Y-%m-%dT%H:%M:%S')
-        df = df[[Counters[i]]]
-        newList.append(df)
-    
-    # Create a data frame whose index is the complete date list    
-    totalDF = pd.DataFrame(index = dfList[3].index)
+def mergeCounters(newList):
+    
+    # Create a data frame whose index is the complete date list of the
+    # longest running counter
+    reference = newList[Counters.index(referenceCounter)]
+    totalDF = pd.DataFrame(index = reference.index)
         
     # Join all the counter data on dates. Note, this counter data only includes bike totals
     totalDF = totalDF.join(newList)
     totalDF = totalDF[~totalDF.index.duplicated(keep='first')]
-    totalDF.index = dfList[3].index
+    totalDF.index = reference.index
     
     return totalDF
 
+def modifyData(dfList):
+    return mergeCounters(normalizeFeeds(dfList))
+
 def markNulls(totalDF):
     
     # This function marks hourly entries as null when they seem defective
@@ -103,24 +153,7 @@ def markNulls(totalDF):
     totalDF.loc["3/12/2017 2:00", "Fremont"] = (totalDF.loc["3/5/2017 2:00", "Fremont"] + totalDF.loc["3/19/2017 2:00", "Fremont"])/2     
     
     # Calculate ratios for imputing values
-    ratios = []
-    # Non-Null Fremont Entries
-    Fremonts = totalDF["Fremont"][totalDF["Fremont"].notnull()]
-    
-    for i in range(10):
-        
-        # Counter name
-        name = Counters[i]
-        
-        # Non-Null Counter i entries
-        Counter = totalDF[totalDF[name].notnull()][name]
-        
-        #Join on rows where they both have values (i.e. have identical indexes)
-        Both = Fremonts.align(Counter, axis = 0, join = 'inner')
-        
-        # Store the ratio of Counter sum / Fremont Sum, which empirically
-        # is 8%-41%
-        ratios.append(sum(Both[1])/sum(Both[0]))
+    ratios = imputationRatios(totalDF)
     
     
     # Identify probable defective values as null, then impute them
@@ -165,14 +198,38 @@ def markNulls(totalDF):
     
     
     # Pseudocode: impute values to null using ratios
-    for i in range(10):
+    for i in range(len(Counters)):
         name = Counters[i]
         Counts = totalDF[name]
-        totalDF.loc[Counts.isnull(), name] = ratios[i]*totalDF.loc[Counts.isnull()]["Fremont"]
+        totalDF.loc[Counts.isnull(), name] = ratios[i]*totalDF.loc[Counts.isnull()][referenceCounter]
     
     
     return totalDF
 
+def imputationRatios(totalDF):
+    # Ratio of each counter's counts to the reference counter's, over the
+    # hours where both have values, in Counters order
+    ratios = []
+    # Non-Null Fremont Entries
+    Fremonts = totalDF[referenceCounter][totalDF[referenceCounter].notnull()]
+    
+    for i in range(len(Counters)):
+        
+        # Counter name
+        name = Counters[i]
+        
+        # Non-Null Counter i entries
+        Counter = totalDF[totalDF[name].notnull()][name]
+        
+        #Join on rows where they both have values (i.e. have identical indexes)
+        Both = Fremonts.align(Counter, axis = 0, join = 'inner')
+        
+        # Store the ratio of Counter sum / Fremont Sum, which empirically
+        # is 8%-41%
+        ratios.append(sum(Both[1])/sum(Both[0]))
+    
+    return ratios
+
 def getDailyDF(df):
     # Create dataframe that displays daily totals by counter
     #Convert date and time to just date
@@ -182,28 +239,22 @@ def getDailyDF(df):
     
     return df
 
-def updatePredictorsDF():
-    raw = getRawData()
-    dfList = []
-    for i in range(len(raw)):
-        dfList.append(raw[i].copy(deep = True)) # Put raw counter data into list of lists
-    totalDF = modifyData(dfList) # Put list of lists into single dataframe
-    totalDF = markNulls(totalDF) # Replace nulls with imputed values
-    dailyDF = getDailyDF(totalDF) # Convert hourly to weekly data
-    
-    weatherPath = "https://raw.githubusercontent.com/cspitmit03/data602-finalproject/master/weatherDF.csv"
-    weatherDF = pd.read_csv(weatherPath, index_col = 0)
-    Indx = [] # Index to house dates
-    for i in range(len(weatherDF)): 
-        Indx.append(datetime.strptime(weatherDF.index[i], '%Y-%m-%d').date())
-    weatherDF.index = Indx
+def readWeather(path = weatherPath):
+    # Daily weather, indexed by date, with the log of the rainfall
+    weatherDF = pd.read_csv(path, index_col = 0, float_precision = 'round_trip')
+    weatherDF.index = pd.to_datetime(weatherDF.index, format = '%Y-%m-%d')
     weatherDF["logPrecip"] = np.log(weatherDF["Precip"] + 1)
-    
-    predictorsDF = pd.concat([dailyDF, weatherDF], axis = 1)
-           
-    #predPath = r"C:\Users\asher\Documents\GitHub\data602-finalproject\predictorsDF.csv"
-    predictorsDF.to_csv(predPath)
-    
+    return weatherDF
+
+def joinWeather(dailyDF, weatherDF):
+    return pd.concat([dailyDF, weatherDF], axis = 1).rename_axis("Date")
+
+# Both updates run the refresh pipeline (see Pipeline.py), which downloads
+# the feeds once and caches every stage, so running one after the other
+# does not repeat any work
+def updatePredictorsDF():
+    from Pipeline import refresh
+    refresh(outputs = ["predictorsDF"])
     return
 
 # Update Bike Counts (to be performed monthly, followed by a push to github)
@@ -211,14 +262,8 @@ def updateHistDF():
     
     # Pull data from Seattle data portal, then write to local Github repo
     # Counts in this DF are not edited; they are used for historical viewing
-    raw = getRawData()
-    dfList = []
-    for i in range(len(raw)):
-        dfList.append(raw[i].copy(deep = True))
-    histDF = modifyData(dfList)
-    #histPath = r"C:\Users\asher\Documents\GitHub\data602-finalproject\histDF.csv"
-    histDF.to_csv(histPath)
- 
+    from Pipeline import refresh
+    refresh(outputs = ["histDF"])
     return
 
 def getDaylightList(end = datetime(2017, 11, 30)):
@@ -268,7 +313,7 @@ def addDaylightToWeatherCSV():
     
     return
 
-def updateAll():
+def updateAll(incremental = False):
     
     # To update code:
     
@@ -278,7 +323,14 @@ def updateAll():
     # Add the daylight hours
     addDaylightToWeatherCSV()
     
-    updateHistDF()
-    updatePredictorsDF()
+    # Incrementally: download only the hours since the last update, and
+    # recompute only the days they touch (see IncrementalUpdate.py)
+    if incremental:
+        from IncrementalUpdate import updateIncremental
+        updateIncremental()
+        return
+    
+    from Pipeline import refresh
+    refresh()
     
     return
@@ -0,0 +1,127 @@
+from collections import OrderedDict
+import threading
+import numpy as np
+from Metrics import addCollector
+
+# Process-wide cache of dashboard results, keyed by normalized widget state.
+#
+# Bokeh runs every session of every app in the same server process, so a
+# module level cache is shared by all sessions of HistoricalDashboard.py and
+# Predict.py. Entries are grouped by namespace (one per app); each namespace
+# remembers a token describing the data its entries were computed from, and
+# is emptied when that token changes, i.e. when the data has been reloaded.
+
+class ResultCache:
+
+    def __init__(self, maxEntries = 512, maxBytes = 64*1024*1024):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict() # (namespace, key) -> (value, size)
+        self.tokens = {} # namespace -> data token
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.namespaceCounts = {} # namespace -> [hits, misses]
+        self.lock = threading.Lock()
+
+    def get(self, namespace, key):
+        # Return the cached value, or None on a miss
+        with self.lock:
+            entry = self.entries.get((namespace, key))
+            counts = self.namespaceCounts.setdefault(namespace, [0, 0])
+            if entry is None:
+                self.misses += 1
+                counts[1] += 1
+                return None
+            self.entries.move_to_end((namespace, key))
+            self.hits += 1
+            counts[0] += 1
+            return entry[0]
+
+    def put(self, namespace, key, value):
+        # Store a dict of arrays, evicting least recently used entries until
+        # the cache fits within its entry and byte limits
+        size = sum(np.asarray(v).nbytes for v in value.values())
+        with self.lock:
+            old = self.entries.pop((namespace, key), None)
+            if old is not None: self.nbytes -= old[1]
+            self.entries[(namespace, key)] = (value, size)
+            self.nbytes += size
+            while self.entries and (len(self.entries) > self.maxEntries or
+                                    self.nbytes > self.maxBytes):
+                _, (_, evicted) = self.entries.popitem(last = False)
+                self.nbytes -= evicted
+
+    def validate(self, namespace, token):
+        # Drop the namespace's entries if they were computed from other data
+        with self.lock:
+            if self.tokens.get(namespace) == token: return
+            self.tokens[namespace] = token
+            for k in [k for k in self.entries if k[0] == namespace]:
+                self.nbytes -= self.entries.pop(k)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tokens.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        # Hit and miss counts, in total and by namespace, plus the current
+        # size of the cache
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hitRate": self.hits/total if total else 0.0,
+                    "entries": len(self.entries),
+                    "bytes": self.nbytes,
+                    "namespaces": {n: {"hits": h, "misses": m}
+                                   for n, (h, m) in self.namespaceCounts.items()}}
+
+def dataToken(*frames):
+    # Cheap fingerprint of the dataframes a namespace's results depend on:
+    # shape, index bounds and the total of the numeric values of each frame
+    token = []
+    for df in frames:
+        numeric = df.select_dtypes(include = [np.number]).values
+        token.append((df.shape, str(df.index[0]), str(df.index[-1]),
+                      float(np.nansum(numeric))))
+    return tuple(token)
+
+def normalizeRange(values, digits = 2):
+    # Slider ranges arrive as lists or tuples of floats
+    return tuple(round(float(v), digits) for v in values)
+
+def dashboardKey(view, counter, years, months, weekdays, hours, light,
+                 weather, rain):
+    # Normalized key for a HistoricalDashboard widget state; counter is None
+    # for results that hold every counter
+    return (view, counter, tuple(sorted(years)), tuple(sorted(months)),
+            tuple(sorted(weekdays)), normalizeRange(hours, 0),
+            normalizeRange(light, 0), tuple(sorted(weather)),
+            normalizeRange(rain))
+
+# The cache shared by every session in this process
+resultCache = ResultCache()
+
+def cacheMetrics():
+    # Hit rates and size of the cache, by namespace, for Metrics
+    stats = resultCache.stats()
+    namespaces = stats["namespaces"]
+    def rate(c):
+        total = c["hits"] + c["misses"]
+        return c["hits"]/total if total else 0.0
+    return [("cache_hits_total", "counter", "Result cache hits",
+             [({"namespace": n}, c["hits"]) for n, c in namespaces.items()]),
+            ("cache_misses_total", "counter", "Result cache misses",
+             [({"namespace": n}, c["misses"]) for n, c in namespaces.items()]),
+            ("cache_hit_ratio", "gauge", "Share of result cache lookups that hit",
+             [({"namespace": n}, rate(c)) for n, c in namespaces.items()] +
+             [({"namespace": "all"}, stats["hitRate"])]),
+            ("cache_entries", "gauge", "Entries in the result cache",
+             [({}, stats["entries"])]),
+            ("cache_bytes", "gauge", "Estimated bytes held by the result cache",
+             [({}, stats["bytes"])])]
+
+addCollector(cacheMetrics)
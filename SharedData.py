@@ -0,0 +1,66 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+from Snapshot import loadFrame, dataDir
+from Counters import standardColumns
+
+# Data shared by every session of the Bokeh apps in a server process.
+#
+# bokeh serve re-executes HistoricalDashboard.py, Predict.py and
+# BokehDownload.py for each browser session, but imported modules are only
+# executed once per process. Anything stored here is therefore loaded by the
+# first session that needs it, and later sessions only hold references to it.
+# Shared values must be treated as read-only by the apps.
+
+lock = threading.RLock()
+store = {}
+
+def shared(name, factory):
+    # Return the process-wide value stored under name, calling factory() to
+    # create it on first use
+    with lock:
+        if name not in store:
+            store[name] = factory()
+        return store[name]
+
+def reset(name = None):
+    # Forget one shared value, or all of them, so they are loaded again by
+    # the next session (e.g. after the monthly data refresh)
+    with lock:
+        if name is None: store.clear()
+        else: store.pop(name, None)
+
+def loadHistDF():
+    # Columns named as in the counter registry
+    return standardColumns(loadFrame("histDF"))
+
+def loadWeatherDF():
+    weatherDF = loadFrame("weatherDF")
+    weatherDF["Precip"] = pd.to_numeric(weatherDF["Precip"])
+    return weatherDF
+
+def loadPredictorsDF():
+    predictorsDF = standardColumns(loadFrame("predictorsDF"))
+    predictorsDF["logPrecip"] = np.log(predictorsDF["Precip"]+1) # Add a log(precipitation) column
+    return predictorsDF
+
+def loadText(filename):
+    with open(os.path.join(dataDir, filename)) as f:
+        return f.read()
+
+def getHistDF():
+    # Hourly counts from the Seattle Data Portal, indexed by datetime
+    return shared("histDF", loadHistDF)
+
+def getWeatherDF():
+    # Daily weather and daylight hours, indexed by date
+    return shared("weatherDF", loadWeatherDF)
+
+def getPredictorsDF():
+    # Daily counts joined with the weather, indexed by date
+    return shared("predictorsDF", loadPredictorsDF)
+
+def getDownloadJS():
+    # Browser code for BokehDownload's CSV export button
+    return shared("download.js", lambda: loadText("download.js"))
@@ -0,0 +1,147 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from Metrics import timed
+
+# Binary columnar snapshots of the CSV datasets.
+#
+# Parsing histDF.csv and rebuilding its index one strptime call at a time
+# took seconds per Bokeh session. A snapshot stores the columns of a dataset
+# as typed NumPy arrays, with the index as datetime64, in .npy files that are
+# memory-mapped on load. The columns of each dtype are stored together, one
+# row per column, which is how pandas lays out a block, so a frame is built
+# on the mapped pages without copying them. This holds for histDF, all of
+# whose columns are floats; frames of mixed dtypes are copied into memory to
+# restore their column order, and string columns are always read into
+# memory. The mapping is copy-on-write, so frames can be modified without
+# touching the files. Snapshots are written next to the CSV they were made
+# from, and are rebuilt whenever that CSV changes.
+#
+# Usage:
+#     histDF = loadFrame("histDF")
+
+snapshotVersion = 2
+
+# Directory of the checked-in CSVs, and of the snapshots built from them
+dataDir = os.path.dirname(os.path.realpath(__file__))
+snapshotDir = os.path.join(dataDir, "snapshots")
+
+# CSV file, index date format, and whether the index holds dates (as opposed
+# to timestamps), for each dataset
+datasets = {"histDF": {"csv": "histDF.csv", "format": "%Y-%m-%d %H:%M:%S",
+                       "dates": False},
+            "weatherDF": {"csv": "weatherDF.csv", "format": "%Y-%m-%d",
+                          "dates": True},
+            "predictorsDF": {"csv": "predictorsDF.csv", "format": "%Y-%m-%d",
+                             "dates": True}}
+
+def sourceStamp(path):
+    # Size and modification time of the CSV a snapshot was made from
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+def readCSV(name, path):
+    # Parse a dataset's CSV, converting the index in a single vectorized call
+    df = pd.read_csv(path, index_col = 0)
+    df.index = pd.to_datetime(df.index, format = datasets[name]["format"])
+    df.index.name = None
+    return df
+
+def writeSnapshot(name, df, source):
+    # Write a .npy file per dtype (and per string column) plus the index,
+    # then publish them by atomically replacing the snapshot's meta.json.
+    # Files from older snapshots of the dataset are removed afterwards.
+    folder = os.path.join(snapshotDir, name)
+    os.makedirs(folder, exist_ok = True)
+    stamp = "%d-%d" % (os.getpid(), source["mtime"])
+
+    np.save(os.path.join(folder, stamp + "-index.npy"),
+            df.index.values.astype('datetime64[ns]'))
+    groups = {} # Columns by dtype, in frame order
+    strings = []
+    for i, col in enumerate(df.columns):
+        values = df[col].values
+        if values.dtype == object: # Strings, with missing values masked
+            nulls = pd.isnull(values)
+            entry = {"name": col, "file": "%s-s%d.npy" % (stamp, i),
+                     "nulls": "%s-s%d-nulls.npy" % (stamp, i)}
+            np.save(os.path.join(folder, entry["file"]), np.where(nulls, '', values).astype(str))
+            np.save(os.path.join(folder, entry["nulls"]), nulls)
+            strings.append(entry)
+        else:
+            groups.setdefault(values.dtype.str, []).append(col)
+    blocks = []
+    for i, cols in enumerate(groups.values()):
+        entry = {"columns": cols, "file": "%s-b%d.npy" % (stamp, i)}
+        np.save(os.path.join(folder, entry["file"]),
+                np.ascontiguousarray(np.stack([df[col].values for col in cols])))
+        blocks.append(entry)
+
+    meta = {"version": snapshotVersion, "source": source, "rows": len(df),
+            "index": stamp + "-index.npy", "columns": list(df.columns),
+            "blocks": blocks, "strings": strings}
+    temp = os.path.join(folder, "meta.json.%d" % os.getpid())
+    with open(temp, 'w') as output:
+        json.dump(meta, output)
+    os.replace(temp, os.path.join(folder, "meta.json"))
+
+    current = set([meta["index"]] + [b["file"] for b in blocks] +
+                  [s["file"] for s in strings] + [s["nulls"] for s in strings])
+    for f in os.listdir(folder):
+        if f.endswith(".npy") and f not in current:
+            try: os.remove(os.path.join(folder, f))
+            except OSError: pass # Another process may be reading it
+
+def readSnapshot(name, source):
+    # Return the dataset from its snapshot, or None if the snapshot is
+    # missing, was written by another snapshot version, or is older than the
+    # CSV it was made from
+    folder = os.path.join(snapshotDir, name)
+    try:
+        with open(os.path.join(folder, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["version"] != snapshotVersion or meta["source"] != source:
+            return None
+
+        index = pd.DatetimeIndex(np.load(os.path.join(folder, meta["index"])))
+        frames = []
+        for entry in meta["blocks"]:
+            # Columns x rows, the transpose of the frame, as a pandas block
+            values = np.load(os.path.join(folder, entry["file"]), mmap_mode = 'c')
+            frames.append(pd.DataFrame(values.T, index = index, columns = entry["columns"],
+                                       copy = False))
+        for entry in meta["strings"]:
+            values = np.load(os.path.join(folder, entry["file"])).astype(object)
+            values[np.load(os.path.join(folder, entry["nulls"]))] = np.nan
+            frames.append(pd.DataFrame({entry["name"]: values}, index = index))
+    except (OSError, ValueError, KeyError):
+        return None
+
+    if not frames: return pd.DataFrame(index = index)
+    df = frames[0] if len(frames) == 1 else pd.concat(frames, axis = 1, copy = False)
+    if list(df.columns) != meta["columns"]:
+        df = df[meta["columns"]]
+    return df
+
+def loadFrame(name, csvPath = None):
+    # Return a dataset ready to use: from its snapshot when it is up to date,
+    # otherwise from the CSV, refreshing the snapshot along the way.
+    # Datasets of daily values are indexed by date objects, as the dashboards
+    # and models expect.
+    path = csvPath or os.path.join(dataDir, datasets[name]["csv"])
+    source = sourceStamp(path)
+
+    with timed("load", dataset = name, source = "snapshot"):
+        df = readSnapshot(name, source)
+    if df is None:
+        with timed("load", dataset = name, source = "csv"):
+            df = readCSV(name, path)
+        try:
+            writeSnapshot(name, df, source)
+        except OSError:
+            pass # Read-only checkout; the CSV is used every time
+
+    if datasets[name]["dates"]:
+        df.index = df.index.date
+    return df
@@ -0,0 +1,147 @@
+import logging
+import numpy as np
+from bokeh.core.json_encoder import serialize_json
+from Metrics import addCollector
+
+# Minimal-payload updates of Bokeh ColumnDataSources.
+#
+# Assigning source.data re-serializes every column of the source, even when
+# only one of them changed. A SourceUpdater remembers the columns last sent to
+# the browser and, for new data, sends the least it can:
+#   - nothing for columns that did not change
+#   - a stream of the new points, when a line was extended or shifted along
+#     (e.g. panning the Historical view)
+#   - patches of the changed slices, when few values changed
+#   - otherwise only the changed columns, as contiguous typed NumPy arrays,
+#     which the Bokeh server sends as binary buffers
+# Counts are sent as float32. Columns listed as precise (x values in ms since
+# the epoch need more than float32's 24 bits) are sent as float64, since
+# Bokeh cannot send int64 arrays as binary buffers.
+#
+# Every update records an estimate of the bytes it sent: the size of the
+# binary buffers, plus the JSON encoded size of streamed and patched values.
+
+log = logging.getLogger(__name__)
+
+# Patch at most this share of a column, in at most this many slices
+patchShare = 0.25
+patchSlices = 8
+
+# Totals over every SourceUpdater in the process
+payloadStats = {"updates": 0, "bytes": 0, "skipped": 0, "streamed": 0,
+                "patched": 0, "replaced": 0}
+
+def payloadMetrics():
+    # Totals of payloadStats, for Metrics
+    return [("source_updates_total", "counter", "Source updates, by how they were sent",
+             [({"kind": k}, payloadStats[k])
+              for k in ["skipped", "streamed", "patched", "replaced"]]),
+            ("source_bytes_total", "counter", "Estimated bytes sent by source updates",
+             [({}, payloadStats["bytes"])])]
+
+addCollector(payloadMetrics)
+
+def jsonSize(values):
+    # Bokeh sends streamed and patched values as JSON lists
+    return len(serialize_json(values))
+
+def sameValues(a, b):
+    # Elementwise equality, with NaN equal to NaN
+    return (a == b) | (np.isnan(a) & np.isnan(b))
+
+def changedSlices(old, new):
+    # Slices covering the values of new that differ from old
+    changed = np.flatnonzero(~sameValues(old, new))
+    if not len(changed): return []
+    breaks = np.flatnonzero(np.diff(changed) > 1)
+    starts = np.append(changed[0], changed[breaks + 1])
+    ends = np.append(changed[breaks], changed[-1]) + 1
+    return [slice(int(s), int(e)) for s, e in zip(starts, ends)]
+
+def shiftOffset(old, new):
+    # Number of points k dropped from the start of old, such that new begins
+    # with old[k:], or None. Only sorted columns (x values) are searched.
+    if not len(old) or not len(new) or np.any(np.diff(old) < 0): return None
+    k = int(np.searchsorted(old, new[0]))
+    tail = old[k:]
+    if len(tail) > len(new) or not np.all(sameValues(tail, new[:len(tail)])):
+        return None
+    return k
+
+class SourceUpdater:
+
+    def __init__(self, source, precise = ("x",)):
+        self.source = source
+        self.precise = precise
+        self.sent = {k: self.typed(k, v) for k, v in source.data.items()}
+        self.stats = {"updates": 0, "bytes": 0, "lastBytes": 0}
+
+    def typed(self, name, values):
+        # Contiguous array of the dtype a column is sent as
+        dtype = np.float64 if name in self.precise else np.float32
+        return np.ascontiguousarray(values, dtype = dtype)
+
+    def update(self, data):
+        # Make the source hold data, a dict of columns, sending only the
+        # changes to the browser. Returns the estimated bytes sent.
+        new = {k: self.typed(k, v) for k, v in data.items()}
+        old = self.sent
+        self.sent = new
+
+        if set(new) != set(old): # Different columns: replace the lot
+            self.source.data = new
+            return self.record("replaced", sum(v.nbytes for v in new.values()))
+
+        lengths = set(len(v) for v in new.values())
+        oldLength = len(next(iter(old.values()))) if old else 0
+        if len(lengths) > 1: # Inconsistent columns are left to Bokeh to reject
+            self.source.data = new
+            return self.record("replaced", sum(v.nbytes for v in new.values()))
+        length = lengths.pop() if lengths else 0
+
+        if length == oldLength and all(not len(changedSlices(old[k], new[k]))
+                                       for k in new):
+            return self.record("skipped", 0)
+
+        # Streaming keeps the last length points of old followed by the new
+        # ones, which works when every column is shifted by the same offset
+        offsets = set(shiftOffset(old[k], new[k]) for k in new if k in self.precise)
+        k = offsets.pop() if len(offsets) == 1 else None
+        if k is not None and oldLength - k < length and (k or length > oldLength):
+            kept = oldLength - k
+            if all(np.all(sameValues(old[c][k:], new[c][:kept])) for c in new):
+                tail = {c: new[c][kept:] for c in new}
+                self.source.stream(tail, rollover = length)
+                return self.record("streamed", sum(jsonSize(v) for v in tail.values()))
+
+        if length == oldLength:
+            patches = {}
+            replace = {}
+            for k in new:
+                slices = changedSlices(old[k], new[k])
+                if not slices: continue
+                changed = sum(s.stop - s.start for s in slices)
+                if changed <= patchShare*length and len(slices) <= patchSlices:
+                    patches[k] = [(s, new[k][s]) for s in slices]
+                else:
+                    replace[k] = new[k]
+            nbytes = sum(v.nbytes for v in replace.values())
+            if replace:
+                self.source.data.update(replace)
+            if patches:
+                self.source.patch(patches)
+                nbytes += sum(jsonSize(v) for p in patches.values() for _, v in p)
+            return self.record("replaced" if replace else "patched", nbytes)
+
+        self.source.data.update(new)
+        return self.record("replaced", sum(v.nbytes for v in new.values()))
+
+    def record(self, kind, nbytes):
+        self.stats["updates"] += 1
+        self.stats["bytes"] += nbytes
+        self.stats["lastBytes"] = nbytes
+        payloadStats["updates"] += 1
+        payloadStats["bytes"] += nbytes
+        payloadStats[kind] += 1
+        log.debug("%s update of %s: %d bytes", kind, self.source._id, nbytes)
+        return nbytes
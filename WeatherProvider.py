@@ -0,0 +1,234 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+from ForecastService import localNow
+from Metrics import timed
+
+# Weather forecasts for Predict.py, from swappable backends.
+#
+# A backend's fetch() returns the daily forecast from today on, as a
+# dataframe indexed by date with Precip (inches) and TempHi (Fahrenheit)
+# columns:
+#   WundergroundProvider  the Wunderground 10 day forecast API, or any URL
+#                         serving the same JSON (e.g. a local test server)
+#   FileProvider          a file in that format, e.g. fixtures/forecast10day.json
+#   ClimateProvider       the typical weather of each calendar day in
+#                         weatherDF, which needs no network at all
+#
+# The app reads the forecast through a CachedProvider, which keeps the last
+# forecast for `ttl` seconds and lets concurrent sessions share one request
+# in flight. A request that takes longer than `timeout` seconds or fails is
+# answered with the last forecast, however old, or failing that with the
+# fallback backend (the climate), so a slow or dead weather API delays a
+# page by at most `timeout`. A failed backend is retried after `retry`
+# seconds, while the fallbacks are served. forecastFor(dates) aligns the
+# forecast on the days asked for, filling any it lacks from the climate.
+#
+# BIKE_WEATHER selects the backend: a URL or a file path. The Wunderground
+# API is used by default.
+
+log = logging.getLogger(__name__)
+
+wundergroundURL = 'http://api.wunderground.com/api/91468d8e9a46ecc5/forecast10day/q/WA/Seattle.json'
+
+# Requests run here, so that callers can stop waiting for them
+executor = ThreadPoolExecutor(max_workers = 2)
+
+class WeatherUnavailable(Exception):
+    pass
+
+def parseWunderground(data):
+    # Daily forecast from a Wunderground forecast10day response
+    days = data["forecast"]["simpleforecast"]["forecastday"]
+    dates = [date(d["date"]["year"], d["date"]["month"], d["date"]["day"]) for d in days]
+    return pd.DataFrame({"Precip": [float(d["qpf_allday"]["in"] or 0) for d in days],
+                         "TempHi": [float(d["high"]["fahrenheit"]) for d in days]},
+                        index = dates, columns = ["Precip", "TempHi"])
+
+class WundergroundProvider:
+
+    name = "wunderground"
+
+    def __init__(self, url = wundergroundURL, timeout = 10):
+        self.url = url
+        self.timeout = timeout
+
+    def fetch(self):
+        with urllib.request.urlopen(self.url, timeout = self.timeout) as response:
+            return parseWunderground(json.loads(response.read().decode()))
+
+class FileProvider:
+
+    name = "file"
+
+    def __init__(self, path):
+        self.path = path
+
+    def fetch(self):
+        with open(self.path) as f:
+            return parseWunderground(json.load(f))
+
+class ClimateProvider:
+    # Mean rainfall and high temperature of the days of the year within
+    # `window` days of each forecast date, over the whole weather history
+
+    name = "climate"
+
+    def __init__(self, weatherDF, days = 10, window = 7):
+        self.days = days
+        self.window = window
+        self.dayOfYear = pd.DatetimeIndex(weatherDF.index).dayofyear.values
+        self.precip = pd.to_numeric(weatherDF["Precip"], errors = 'coerce').values
+        self.tempHi = pd.to_numeric(weatherDF["TempHi"], errors = 'coerce').values
+
+    def fetch(self):
+        today = localNow().date()
+        return self.typical([today + timedelta(days = i) for i in range(self.days)])
+
+    def typical(self, dates):
+        # The typical weather of the given dates
+        precip, tempHi = [], []
+        for d in pd.DatetimeIndex(dates).dayofyear.values:
+            distance = np.abs(self.dayOfYear - d)
+            near = np.minimum(distance, 365 - distance) <= self.window
+            precip.append(np.nanmean(self.precip[near]))
+            tempHi.append(np.nanmean(self.tempHi[near]))
+        return pd.DataFrame({"Precip": precip, "TempHi": tempHi}, index = dates,
+                            columns = ["Precip", "TempHi"])
+
+class CachedProvider:
+
+    def __init__(self, provider, fallback = None, ttl = 1800, timeout = 5, retry = 60):
+        self.provider = provider
+        self.fallback = fallback
+        self.ttl = ttl
+        self.timeout = timeout
+        self.retry = retry
+        self.value = None
+        self.updated = None # time.time() of the last successful fetch
+        self.failed = None # time.time() of the last failed fetch
+        self.lastError = None
+        self.pending = None # Future of the request in flight
+        self.lock = threading.Lock()
+
+    def forecast(self):
+        # The daily forecast: cached, fetched, or a fallback if the backend
+        # is slow or failing. Raises WeatherUnavailable if there is none.
+        now = time.time()
+        with self.lock:
+            if self.value is not None and now - self.updated < self.ttl:
+                return self.value
+            if self.pending is None and (self.failed is None or
+                                         now - self.failed >= self.retry):
+                self.pending = executor.submit(self.refresh)
+            pending = self.pending
+        if pending is not None:
+            try:
+                return pending.result(timeout = self.timeout)
+            except Exception as e: # Including the timeout
+                reason = "%s: %s" % (type(e).__name__, e) if str(e) else type(e).__name__
+        else:
+            reason = "retrying after %s" % self.lastError
+        return self.fallbackForecast(reason)
+
+    def forecastFor(self, dates):
+        # The forecast of the given dates. A stale forecast can start on an
+        # earlier day and end too soon, so it is aligned on the dates, and
+        # the days it lacks are filled from the fallback.
+        forecast = self.forecast().reindex(dates)
+        missing = forecast.isnull().any(axis = 1).values
+        if missing.any():
+            if self.fallback is None:
+                raise WeatherUnavailable("No forecast for %d of the %d days" %
+                                         (missing.sum(), len(dates)))
+            log.warning("Filling %d of the %d forecast days with the %s weather",
+                        missing.sum(), len(dates), self.fallback.name)
+            forecast = forecast.fillna(self.fallback.typical(dates))
+        return forecast
+
+    def refresh(self):
+        # Fetch from the backend, in a worker thread
+        try:
+            with timed("weather", backend = self.provider.name):
+                value = self.provider.fetch()
+            with self.lock:
+                self.value, self.updated = value, time.time()
+                self.failed = self.lastError = None
+            return value
+        except Exception as e:
+            with self.lock:
+                self.failed = time.time()
+                self.lastError = "%s: %s" % (type(e).__name__, e)
+            log.exception("Weather forecast from %s failed", self.provider.name)
+            raise
+        finally:
+            with self.lock:
+                self.pending = None
+
+    def fallbackForecast(self, reason):
+        if self.value is not None:
+            log.warning("Serving the weather forecast of %d minutes ago (%s)",
+                        (time.time() - self.updated) // 60, reason)
+            return self.value
+        if self.fallback is not None:
+            log.warning("Serving the %s weather instead of a forecast (%s)",
+                        self.fallback.name, reason)
+            return self.fallback.fetch()
+        raise WeatherUnavailable(reason)
+
+def defaultProvider(weatherDF = None):
+    # The backend named by BIKE_WEATHER, cached, falling back to the
+    # climate of weatherDF when it is given
+    source = os.environ.get("BIKE_WEATHER", wundergroundURL)
+    if re.match("https?://", source): backend = WundergroundProvider(source)
+    else: backend = FileProvider(source)
+    fallback = ClimateProvider(weatherDF) if weatherDF is not None else None
+    return CachedProvider(backend, fallback = fallback)
+
+class FailingProvider:
+    # A backend that is down
+
+    name = "failing"
+
+    def fetch(self):
+        raise OSError("The weather API is down")
+
+def checkStale(weatherDF, days = 7):
+    # Raise unless a forecast fetched yesterday, served while the backend
+    # fails, still gives `days` rows starting today
+    climate = ClimateProvider(weatherDF)
+    today = localNow().date()
+    provider = CachedProvider(FailingProvider(), fallback = climate)
+    provider.value = climate.typical([today - timedelta(days = 1) + timedelta(days = i)
+                                      for i in range(days)])
+    provider.updated = time.time() - 86400
+    dates = [today + timedelta(days = i) for i in range(days)]
+    forecast = provider.forecastFor(dates)
+    if list(forecast.index) != dates or forecast.isnull().values.any():
+        raise AssertionError("Stale forecast misaligned:\n%s" % forecast)
+    return forecast
+
+if __name__ == "__main__":
+    import argparse
+    from SharedData import getWeatherDF
+    parser = argparse.ArgumentParser(description = "Print the weather forecast")
+    parser.add_argument("--check", action = "store_true",
+                        help = "check that a stale forecast is aligned on today instead")
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO)
+    if args.check:
+        print(checkStale(getWeatherDF()))
+        print("A forecast fetched yesterday gives the days from today on")
+    else:
+        provider = defaultProvider(getWeatherDF())
+        start = time.perf_counter()
+        print(provider.forecast())
+        print("Forecast in %.2f s" % (time.perf_counter() - start))
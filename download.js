@@ -1,21 +1,15 @@
 var data = source.data;
-var filetext = 'Date, BGT, Broad, Elliot, Fremont, MTS, NW58, Second, Spokane, Thirty, TwoSix\n';
-for (i=0; i < data['Fremont'].length; i++) {
-    var currRow = [data['Date'][i].toString(),
-                  data['BGT'][i].toString(),
-                  data['Broad'][i].toString(),
-                  data['Elliot'][i].toString(),
-                  data['Fremont'][i].toString(),
-                  data['MTS'][i].toString(),
-                  data['NW58'][i].toString(),
-                  data['Second'][i].toString(),
-                  data['Spokane'][i].toString(),
-                  data['Thirty'][i].toString(),
-                  data['TwoSix'][i].toString().concat('\n')
-                 ];
+// One column per counter, in the order BokehDownload.py set them
+var columns = Object.keys(data).filter(function (k) { return k != 'Date'; });
+var filetext = ['Date'].concat(columns).join(', ').concat('\n');
+for (i=0; i < data['Date'].length; i++) {
+    var currRow = [data['Date'][i].toString()];
+    for (j=0; j < columns.length; j++) {
+        currRow.push(data[columns[j]][i].toString());
+    }
 
     var joined = currRow.join();
-    filetext = filetext.concat(joined);
+    filetext = filetext.concat(joined).concat('\n');
 }
 
 var filename = 'data_result.csv';